@@ -2,19 +2,31 @@
 #copyright notices and license terms.
 from trytond.pool import Pool
 from . import configuration
+from . import invoice
+from . import ir
 from . import purchase
-from . import shipment
+from . import routes
+
+__all__ = ['register', 'routes']
 
 def register():
     Pool.register(
         configuration.Configuration,
         configuration.ConfigurationCompany,
+        invoice.Invoice,
+        ir.Cron,
         purchase.Move,
         purchase.MoveLine,
         purchase.Purchase,
         purchase.PurchaseLine,
-        shipment.ShipmentIn,
+        purchase.StockAccountMoveError,
+        purchase.PendingInvoiceBalance,
+        purchase.PendingInvoiceBalanceContext,
+        purchase.ExportPendingInvoiceStart,
+        purchase.ExportPendingInvoiceResult,
+        purchase.RevaluePendingInvoiceStart,
         module='purchase_stock_account_move', type_='model')
     Pool.register(
-        purchase.HandleShipmentException,
+        purchase.ExportPendingInvoice,
+        purchase.RevaluePendingInvoice,
         module='purchase_stock_account_move', type_='wizard')
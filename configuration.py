@@ -2,6 +2,7 @@
 #this repository contains the full copyright notices and license terms.
 from trytond.model import Model, ModelSQL, fields
 from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Eval
 from trytond.transaction import Transaction
 
 
@@ -13,6 +14,16 @@ class Configuration(metaclass=PoolMeta):
             domain=[
                 ('type', '!=', 'None'),
                 ]), 'get_company_config', 'set_company_config')
+    pending_invoice_export_watermark = fields.Function(fields.Integer(
+            'Pending Invoice Export Watermark', readonly=True),
+        'get_company_config', 'set_company_config')
+    pending_invoice_write_off = fields.Function(fields.Many2One(
+            'account.move.reconcile.write_off',
+            'Pending Invoice Write-Off Method'),
+        'get_company_config', 'set_company_config')
+    pending_invoice_write_off_tolerance = fields.Function(fields.Numeric(
+            'Pending Invoice Write-Off Tolerance'),
+        'get_company_config', 'set_company_config')
 
     @classmethod
     def get_company_config(self, configs, names):
@@ -64,3 +75,16 @@ class ConfigurationCompany(ModelSQL):
             domain=[
                 ('type', '!=', 'None'),
                 ])
+    pending_invoice_export_watermark = fields.Integer(
+        'Pending Invoice Export Watermark', readonly=True,
+        help="The last pending invoice line exported.")
+    pending_invoice_write_off = fields.Many2One(
+        'account.move.reconcile.write_off',
+        'Pending Invoice Write-Off Method',
+        domain=[
+            ('company', '=', Eval('company', -1)),
+            ])
+    pending_invoice_write_off_tolerance = fields.Numeric(
+        'Pending Invoice Write-Off Tolerance',
+        help="The maximum difference written off when reconciling the "
+        "pending invoice lines of a purchase.")
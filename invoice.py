@@ -0,0 +1,19 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+
+class Invoice(metaclass=PoolMeta):
+    __name__ = 'account.invoice'
+
+    @classmethod
+    def _post(cls, invoices):
+        pool = Pool()
+        PurchaseLine = pool.get('purchase.line')
+
+        super(Invoice, cls)._post(invoices)
+        lines = {l.origin for i in invoices for l in i.lines
+            if isinstance(l.origin, PurchaseLine)}
+        # Book only the purchase lines invoiced
+        PurchaseLine.create_stock_account_moves(
+            PurchaseLine.browse(sorted(l.id for l in lines)))
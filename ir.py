@@ -0,0 +1,17 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import PoolMeta
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super(Cron, cls).__setup__()
+        cls.method.selection.extend([
+                ('purchase.purchase|create_pending_invoice_moves',
+                    "Book Pending Invoice Moves"),
+                ('purchase.purchase|reconcile_pending_invoice_lines',
+                    "Reconcile Pending Invoice Lines"),
+                ])
@@ -1,13 +1,113 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import cProfile
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+import urllib.parse
+import warnings
+from bisect import bisect_right
+from collections import defaultdict
 from decimal import Decimal
 from datetime import datetime
-from trytond.model import fields
+from itertools import groupby
+from operator import itemgetter
+from sql import Column, Literal, Null
+from sql.aggregate import Count, Max, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import Abs
+from sql.operators import Concat, Exists
+from trytond import backend
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.i18n import gettext
+from trytond.model import Index, ModelSQL, ModelView, fields
+from trytond.modules.currency.fields import Monetary
 from trytond.pool import Pool, PoolMeta
-from trytond.pyson import Eval
+from trytond.pyson import Eval, PYSONEncoder
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
+from trytond.url import http_host
+from trytond.wizard import (
+    Button, StateAction, StateTransition, StateView, Wizard)
 
 _ZERO = Decimal(0)
+# Profiling is enabled for calls slower than the threshold in seconds
+_PROFILE_THRESHOLD = config.getfloat(
+    'purchase_stock_account_move', 'profile_threshold', default=None)
+_PROFILE_DIRECTORY = config.get(
+    'purchase_stock_account_move', 'profile_directory', default=None)
+# Tracing the memory of chunked bookings slows down every allocation
+_TRACE_MEMORY = config.getboolean(
+    'purchase_stock_account_move', 'trace_memory', default=False)
+logger = logging.getLogger(__name__)
+
+def _booked_state(count, amount, max_id):
+    "Return the marker of the booked lines with a normalized amount"
+    return count, str(Decimal(str(amount or 0)).normalize()), max_id
+
+
+def _merge_until(values, date):
+    "Return values with the ones of the keys until date summed at date"
+    merged = {}
+    for key, value in values.items():
+        key = max(key, date)
+        merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+def _compute_pending_amounts(
+        line_ids, dates, quantities, prices, rates, booked, round):
+    """
+    Return the list of (line id, date, pending amount, purchase quantity)
+    with a non-zero pending amount
+
+    line_ids, dates, quantities, prices and rates are columns of the same
+    length with the quantity pending to invoice at the date, the unit price
+    and the (to rate, from rate) pair or None when no conversion is needed.
+    booked maps (line id, date) to the (amount, quantity) already booked
+    where the quantity is None when it is unknown.
+    The amount is converted and rounded once per line and date like
+    Currency.compute does.
+    """
+    # Buckets by line in the order of the columns, so only the dates of each
+    # line are sorted
+    buckets = {}
+    for line_id, date, quantity, price, rate in zip(
+            line_ids, dates, quantities, prices, rates):
+        line_buckets = buckets.setdefault(line_id, {})
+        if date in line_buckets:
+            line_buckets[date][0] += quantity
+        else:
+            line_buckets[date] = [quantity, price, rate]
+    line_booked = {}
+    for (line_id, date), value in booked.items():
+        buckets.setdefault(line_id, {})
+        line_booked.setdefault(line_id, {})[date] = value
+
+    result = []
+    for line_id, line_buckets in buckets.items():
+        booked = line_booked.get(line_id, {})
+        for date in sorted(line_buckets.keys() | booked.keys()):
+            quantity, price, rate = line_buckets.get(
+                date, (_ZERO, _ZERO, None))
+            booked_amount, booked_quantity = booked.get(date, (_ZERO, 0))
+            amount = quantity * price
+            if rate:
+                amount = amount * rate[0] / rate[1]
+            amount = round(amount) - booked_amount
+            if amount:
+                purchase_quantity = None
+                if booked_quantity is not None:
+                    purchase_quantity = float(quantity) - booked_quantity
+                result.append((line_id, date, amount, purchase_quantity))
+    return result
 
 # Add sale_stock_account_move module depends temprally, becasue this module is
 #   used only by one client. If it's used by another client we will need to
@@ -24,10 +124,274 @@ class Move(metaclass=PoolMeta):
             origins.append('purchase.purchase')
         return origins
 
+    def _cancel_default(self, reversal=False):
+        default = super(Move, self)._cancel_default(reversal=reversal)
+        # The cancelled quantity is no more booked
+        default['lines.purchase_quantity'] = (
+            lambda data: data['purchase_quantity'] * -1
+            if data['purchase_quantity']
+            else data['purchase_quantity'])
+        return default
+
 
 class MoveLine(metaclass=PoolMeta):
     __name__ = 'account.move.line'
     purchase_line = fields.Many2One('purchase.line', 'Purchase Line')
+    purchase_quantity = fields.Float('Purchase Quantity', readonly=True,
+        help="The quantity in the purchase line unit booked as pending "
+        "invoice.\n"
+        "Empty for the lines booked before it was recorded and for the "
+        "following deltas of their dates.")
+
+    @classmethod
+    def __setup__(cls):
+        super(MoveLine, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                # Index for open pending invoice lines to reconcile
+                Index(
+                    t,
+                    (t.account, Index.Equality()),
+                    (t.purchase_line, Index.Range()),
+                    where=(t.reconciliation == Null)
+                    & (t.purchase_line != Null)),
+                })
+
+    @classmethod
+    def pending_invoice_index_usage(cls):
+        """
+        Return for each index on purchase_line of the table a dictionary with
+        its name, definition, size in bytes, number of scans and of tuples
+        read, to monitor their usage and bloat on PostgreSQL
+        """
+        cursor = Transaction().connection.cursor()
+
+        if backend.name != 'postgresql':
+            return []
+        cursor.execute(
+            'SELECT s.indexrelname, i.indexdef, '
+                'pg_relation_size(s.indexrelid), s.idx_scan, '
+                's.idx_tup_read '
+            'FROM pg_stat_user_indexes AS s '
+            'JOIN pg_indexes AS i '
+                'ON i.schemaname = s.schemaname '
+                'AND i.indexname = s.indexrelname '
+            'WHERE s.relname = %s AND i.indexdef LIKE %s '
+            'ORDER BY s.indexrelname',
+            (cls._table, '%purchase_line%'))
+        keys = ['name', 'definition', 'size', 'scans', 'tuples_read']
+        return [dict(zip(keys, row)) for row in cursor]
+
+    @classmethod
+    def _get_pending_invoice_balance_query(cls, company, date, grouping):
+        """
+        Return the query of the pending invoice balance of company as of
+        date grouped by party, purchase or product.
+        The balance is credit minus debit like in the export and the audit.
+        """
+        pool = Pool()
+        Config = pool.get('purchase.configuration')
+        Move = pool.get('account.move')
+        PurchaseLine = pool.get('purchase.line')
+        Purchase = pool.get('purchase.purchase')
+        line = cls.__table__()
+        move = Move.__table__()
+        purchase_line = PurchaseLine.__table__()
+        purchase = Purchase.__table__()
+
+        with Transaction().set_context(company=company):
+            pending_invoice_account = Config(1).pending_invoice_account
+        key = {
+            'party': purchase.party,
+            'purchase': purchase.id,
+            'product': purchase_line.product,
+            }[grouping]
+        columns = {
+            'party': Literal(None),
+            'purchase': Literal(None),
+            'product': Literal(None),
+            }
+        columns[grouping] = key
+        return (line
+            .join(move, condition=line.move == move.id)
+            .join(purchase_line,
+                condition=line.purchase_line == purchase_line.id)
+            .join(purchase, condition=purchase_line.purchase == purchase.id)
+            .select(
+                key.as_('id'),
+                *[c.as_(n) for n, c in columns.items()],
+                move.company.as_('company'),
+                Sum(line.credit - line.debit).as_('balance'),
+                where=(line.account == (
+                        pending_invoice_account.id
+                        if pending_invoice_account else None))
+                & (move.company == company)
+                & (move.date <= date),
+                group_by=[key, move.company]))
+
+    @classmethod
+    def _get_pending_invoice_export_where(cls, line, move, company, since,
+            until):
+        pool = Pool()
+        Config = pool.get('purchase.configuration')
+
+        with Transaction().set_context(company=company):
+            pending_invoice_account = Config(1).pending_invoice_account
+        if not pending_invoice_account:
+            return
+        where = ((line.account == pending_invoice_account.id)
+            & (move.company == company))
+        if since:
+            where &= line.id > since
+        if until:
+            where &= line.id <= until
+        return where
+
+    @classmethod
+    def get_pending_invoice_export_last_id(cls, company):
+        """
+        Return the id of the last pending invoice line of company.
+        The lines are locked so no line with a lower id can be committed after
+        the call.
+        """
+        pool = Pool()
+        Move = pool.get('account.move')
+        line = cls.__table__()
+        move = Move.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        transaction.database.lock(transaction.connection, cls._table)
+        where = cls._get_pending_invoice_export_where(
+            line, move, company, None, None)
+        if where is None:
+            return
+        cursor.execute(*line
+            .join(move, condition=line.move == move.id)
+            .select(Max(line.id), where=where))
+        last_id, = cursor.fetchone()
+        return last_id
+
+    @classmethod
+    def set_pending_invoice_export_watermark(cls, company, until):
+        "Advance the export watermark of company up to until"
+        pool = Pool()
+        Config = pool.get('purchase.configuration')
+
+        with Transaction().set_context(company=company, _check_access=False):
+            config = Config(1)
+            if (config.pending_invoice_export_watermark or 0) < until:
+                Config.set_company_config(
+                    [config], 'pending_invoice_export_watermark', until)
+
+    @classmethod
+    def export_pending_invoice_lines(cls, company, since=None, until=None):
+        """
+        Yield a dictionary for each pending invoice line of company with an id
+        greater than since and up to until.
+        On PostgreSQL the lines are read with a server-side cursor so only a
+        chunk of them is held in memory.
+        The quantity is empty for the lines booked before it was recorded.
+        """
+        pool = Pool()
+        Move = pool.get('account.move')
+        PurchaseLine = pool.get('purchase.line')
+        Purchase = pool.get('purchase.purchase')
+        Party = pool.get('party.party')
+        Product = pool.get('product.product')
+        line = cls.__table__()
+        move = Move.__table__()
+        purchase_line = PurchaseLine.__table__()
+        purchase = Purchase.__table__()
+        party = Party.__table__()
+        product = Product.__table__()
+        transaction = Transaction()
+
+        where = cls._get_pending_invoice_export_where(
+            line, move, company, since, until)
+        if where is None:
+            return
+
+        if backend.name == 'postgresql':
+            cursor = transaction.connection.cursor('pending_invoice_export')
+            cursor.itersize = transaction.database.IN_MAX
+        else:
+            cursor = transaction.connection.cursor()
+        try:
+            cursor.execute(*line
+                .join(move, condition=line.move == move.id)
+                .join(purchase_line,
+                    condition=line.purchase_line == purchase_line.id)
+                .join(purchase,
+                    condition=purchase_line.purchase == purchase.id)
+                .join(party, condition=purchase.party == party.id)
+                .join(product, 'LEFT',
+                    condition=purchase_line.product == product.id)
+                .select(line.id, purchase.id, purchase.number, party.id,
+                    party.name, product.id, product.code, move.date,
+                    line.purchase_quantity, line.credit - line.debit,
+                    where=where,
+                    order_by=line.id))
+            keys = ['id', 'purchase_id', 'purchase', 'supplier_id',
+                'supplier', 'product_id', 'product', 'date', 'quantity',
+                'amount']
+            while True:
+                rows = cursor.fetchmany(transaction.database.IN_MAX)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(zip(keys, row))
+        finally:
+            cursor.close()
+
+    @classmethod
+    def export_pending_invoice(cls, company, format='csv', since=None,
+            until=None):
+        """
+        Yield the pending invoice lines of company between since and until
+        encoded in format by chunks of bytes
+        """
+        transaction = Transaction()
+
+        data = io.StringIO()
+        writer = None
+        rows = cls.export_pending_invoice_lines(
+            company, since=since, until=until)
+        for i, row in enumerate(rows, 1):
+            if format == 'csv':
+                if writer is None:
+                    writer = csv.DictWriter(data, fieldnames=list(row))
+                    writer.writeheader()
+                writer.writerow(row)
+            else:
+                data.write(json.dumps(row, default=str))
+                data.write('\n')
+            if not i % transaction.database.IN_MAX:
+                yield data.getvalue().encode('utf-8')
+                data.seek(0)
+                data.truncate()
+        if data.tell():
+            yield data.getvalue().encode('utf-8')
+
+    @classmethod
+    def get_pending_invoice_balances(cls, date, grouping='party',
+            company=None, offset=0, limit=None):
+        """
+        Return a list of (id, balance) with the pending invoice balance as of
+        date for each party, purchase or product id depending on grouping
+        """
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        if company is None:
+            company = transaction.context.get('company')
+        query = cls._get_pending_invoice_balance_query(
+            company, date, grouping)
+        query.order_by = [query.columns[0]]
+        query.offset = offset
+        query.limit = limit
+        cursor.execute(*query)
+        return [(r[0], r[-1]) for r in cursor]
 
 
 class Purchase(metaclass=PoolMeta):
@@ -36,52 +400,377 @@ class Purchase(metaclass=PoolMeta):
     @classmethod
     def process(cls, purchases):
         super(Purchase, cls).process(purchases)
-        if not Transaction().context.get('stock_account_move'):
-            for purchase in purchases:
-                purchase.create_stock_account_move()
+        context = Transaction().context
+        if not context.get('stock_account_move'):
+            if context.get('stock_account_move_profile',
+                    _PROFILE_THRESHOLD) is None:
+                cls.create_stock_account_moves(purchases)
+            else:
+                # Profile each purchase on its own
+                for purchase in purchases:
+                    purchase.create_stock_account_move()
 
     def create_stock_account_move(self):
         """
         Create, post and reconcile an account_move (if it is required to do)
         with lines related to Pending Invoices accounts.
         """
+        threshold = Transaction().context.get(
+            'stock_account_move_profile', _PROFILE_THRESHOLD)
+        if threshold is None:
+            self.create_stock_account_moves([self])
+        else:
+            self._profile_stock_account_move(threshold)
+
+    def _profile_stock_account_move(self, threshold):
+        """
+        Create the stock account move under cProfile and dump the statistics
+        if it takes longer than threshold seconds
+        """
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        profiler.runcall(self.create_stock_account_moves, [self])
+        duration = time.perf_counter() - start
+        if duration < threshold:
+            return
+        filename = os.path.join(
+            _PROFILE_DIRECTORY or tempfile.gettempdir(),
+            'purchase-%s-lines-%s-invoice-lines-%s-%s.prof' % (
+                self.id, len(self.lines),
+                sum(len(l.invoice_lines) for l in self.lines),
+                int(time.time())))
+        profiler.dump_stats(filename)
+        logger.info("Pending invoice moves of purchase %s took %.2fs, "
+            "profile dumped to %s", self.id, duration, filename)
+
+    @classmethod
+    def create_stock_account_moves(cls, purchases, lines=None):
+        """
+        Create, post and reconcile in a single batch the account moves with
+        lines related to Pending Invoices accounts of all the purchases.
+        If lines is set, only those purchase lines are booked.
+
+        When the stock_account_move_chunk_size context key is set, the
+        purchase lines are processed in slices of that size which are saved
+        and posted before the record cache is cleared.
+
+        The purchases are grouped by company and each group is booked under
+        the context of its company. With the stock_account_move_queue context
+        key, the groups of a multi-company batch are queued to be booked in
+        parallel.
+
+        The lines whose fingerprint is unchanged since their last booking are
+        skipped. Processing with the stock_account_move_recompute context key
+        recomputes all of them as a full fallback.
+        """
+        transaction = Transaction()
+        context = transaction.context
+        purchases = [p for p in purchases if p.invoice_method == 'shipment']
+        if not purchases:
+            return
+
+        def keyfunc(purchase):
+            return purchase.company.id
+        groups = [(c, list(p)) for c, p in groupby(
+                sorted(purchases, key=keyfunc), key=keyfunc)]
+        queue = (context.get('stock_account_move_queue')
+            and lines is None and len(groups) > 1)
+        for company_id, c_purchases in groups:
+            with transaction.set_context(company=company_id):
+                if queue:
+                    cls.__queue__.create_stock_account_moves(c_purchases)
+                else:
+                    cls._create_stock_account_moves(c_purchases, lines=lines)
+
+    @classmethod
+    def _create_stock_account_moves(cls, purchases, lines=None):
+        """
+        Book the pending invoice moves of purchases of the context company.
+        In chunked mode, the peak of the memory allocated by the call is
+        logged when the stock_account_move_trace context key is set.
+        """
+        transaction = Transaction()
+        context = transaction.context
+        chunk_size = context.get('stock_account_move_chunk_size')
+        tracing = chunk_size and context.get(
+            'stock_account_move_trace', _TRACE_MEMORY)
+
+        trace = tracing and not tracemalloc.is_tracing()
+        if trace:
+            tracemalloc.start()
+        elif tracing:
+            tracemalloc.reset_peak()
+        try:
+            cls._book_stock_account_moves(
+                purchases, lines=lines, chunk_size=chunk_size)
+            if tracing:
+                logger.info("Pending invoice moves of %s purchases booked "
+                    "in chunks of %s lines, peak memory: %s KiB",
+                    len(purchases), chunk_size,
+                    tracemalloc.get_traced_memory()[1] // 1024)
+        finally:
+            if trace:
+                tracemalloc.stop()
+
+    @classmethod
+    def _book_stock_account_moves(cls, purchases, lines=None,
+            chunk_size=None):
+        "Book the pending invoice moves of purchases in chunks of lines"
         pool = Pool()
         Config = pool.get('purchase.configuration')
         Move = pool.get('account.move')
+        PurchaseLine = pool.get('purchase.line')
+        transaction = Transaction()
+        config = Config(1)
+
+        with transaction.set_context(_check_access=False):
+            pending_invoice_account = config.pending_invoice_account
+            # Journal and periods are shared by all the purchases of the
+            # company
+            journal = purchases[0]._get_accounting_journal()
+            periods = {}
+            line_ids = PurchaseLine._get_stock_account_move_line_ids(
+                purchases)
+            if lines is not None:
+                selected = {l.id for l in lines}
+            to_process = [(p.id, l) for p in purchases
+                for l in line_ids.get(p.id, [])
+                if lines is None or l in selected]
+            if chunk_size:
+                chunks = grouped_slice(to_process, chunk_size)
+            else:
+                chunks = [to_process]
+
+            to_reconcile = set()
+            # Resolved only for the lines with an amount to book
+            expense_accounts = {}
+            for chunk in chunks:
+                chunk = list(chunk)
+                account_moves = []
+                to_save = []
+                digests = {}
+                for purchase_id, sub_lines in groupby(
+                        chunk, key=itemgetter(0)):
+                    purchase = cls(purchase_id)
+                    purchase_lines = PurchaseLine.browse(
+                        [l for _, l in sub_lines])
+                    purchase_moves = purchase._get_stock_account_move(
+                        pending_invoice_account, lines=purchase_lines,
+                        expense_accounts=expense_accounts, journal=journal,
+                        periods=periods, digests=digests)
+                    if purchase_moves:
+                        account_moves.extend(purchase_moves)
+                        to_reconcile.add(purchase_id)
+                    to_save.extend(purchase_lines)
+
+                if account_moves:
+                    Move.save(account_moves)
+                    cls._post_stock_account_moves(account_moves)
+                PurchaseLine._set_stock_account_move_fingerprints(
+                    to_save, pending_invoice_account, digests=digests,
+                    moves=account_moves)
+                if chunk_size:
+                    for cache in transaction.cache.values():
+                        cache.clear()
+
+            if to_reconcile:
+                cls._reconcile_stock_account_moves(
+                    cls.browse(sorted(to_reconcile)), pending_invoice_account,
+                    clear_cache=bool(chunk_size))
+
+    @classmethod
+    def create_pending_invoice_moves(cls, purchases=None):
+        """
+        Book the pending invoice moves of the processing purchases of the
+        context company, isolating the failure of each purchase
+        """
+        if purchases is None:
+            purchases = cls.search([
+                    ('company', '=', Transaction().context.get('company')),
+                    ('state', '=', 'processing'),
+                    ('invoice_method', '=', 'shipment'),
+                    ], order=[('id', 'ASC')])
+        return cls.create_stock_account_moves_isolated(purchases)
+
+    @classmethod
+    def create_stock_account_moves_isolated(cls, purchases):
+        """
+        Create the pending invoice moves of each purchase inside its own
+        savepoint, so a failing purchase only rolls back its own moves.
+        The failures are stored as stock account move errors, replacing the
+        previous errors of the purchases, and returned.
+        """
+        pool = Pool()
+        Error = pool.get('purchase.stock_account_move.error')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        errors = []
+        for purchase in purchases:
+            cursor.execute('SAVEPOINT stock_account_move')
+            try:
+                cls.create_stock_account_moves([purchase])
+            except UserError as exception:
+                cursor.execute('ROLLBACK TO SAVEPOINT stock_account_move')
+                # Cached values may come from the rolled back work
+                for cache in transaction.cache.values():
+                    cache.clear()
+                logger.warning("Pending invoice moves of purchase %s "
+                    "failed", purchase.id, exc_info=True)
+                errors.append(Error(
+                        purchase=purchase.id,
+                        company=purchase.company.id,
+                        message=str(exception)))
+            else:
+                cursor.execute('RELEASE SAVEPOINT stock_account_move')
+        # The errors are maintained by the process whatever the user access
+        with transaction.set_context(_check_access=False):
+            for sub_purchases in grouped_slice(purchases):
+                Error.delete(Error.search([
+                            ('purchase', 'in', [p.id for p in sub_purchases]),
+                            ]))
+            if errors:
+                Error.save(errors)
+        return errors
+
+    @classmethod
+    def reconcile_pending_invoice_lines(cls, purchases=None):
+        """
+        Reconcile in one pass the open pending invoice lines of each purchase
+        of the company whose balance is within the write-off tolerance,
+        writing off the difference with the configured method
+        """
+        pool = Pool()
+        Config = pool.get('purchase.configuration')
+        Date = pool.get('ir.date')
         MoveLine = pool.get('account.move.line')
+        PurchaseLine = pool.get('purchase.line')
+        line = MoveLine.__table__()
+        purchase_line = PurchaseLine.__table__()
+        purchase = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
         config = Config(1)
-        if self.invoice_method != 'shipment':
+        pending_invoice_account = config.pending_invoice_account
+        if not pending_invoice_account:
             return
+        write_off = config.pending_invoice_write_off
+        tolerance = _ZERO
+        if write_off:
+            tolerance = config.pending_invoice_write_off_tolerance or _ZERO
 
-        with Transaction().set_context(_check_access=False):
-            account_moves = []
-            account_moves = self._get_stock_account_move(
-                    config.pending_invoice_account)
-
-            if account_moves:
-                Move.save(account_moves)
-                Move.post(account_moves)
-                to_reconcile = MoveLine.search([
-                            ('move.origin', '=', str(self)),
-                            ('account', '=', config.pending_invoice_account),
-                            ('reconciliation', '=', None),
-                            ])
-                credit = sum(l.credit for l in to_reconcile)
-                debit = sum(l.debit for l in to_reconcile)
-                if to_reconcile and credit == debit:
-                    MoveLine.reconcile(to_reconcile)
-
-    def _get_stock_account_move(self, pending_invoice_account):
+        where = ((line.account == pending_invoice_account.id)
+            & (line.reconciliation == Null)
+            & (purchase.company == transaction.context.get('company')))
+        if purchases is not None:
+            where &= reduce_ids(purchase.id, [p.id for p in purchases])
+        cursor.execute(*line
+            .join(purchase_line,
+                condition=line.purchase_line == purchase_line.id)
+            .join(purchase, condition=purchase_line.purchase == purchase.id)
+            .select(purchase.id,
+                where=where,
+                group_by=purchase.id,
+                having=Abs(Sum(line.debit - line.credit)) <= tolerance))
+        purchase_ids = [p for p, in cursor]
+
+        date = Date.today()
+        with transaction.set_context(_check_access=False):
+            for sub_ids in grouped_slice(purchase_ids):
+                lines = MoveLine.search([
+                        ('purchase_line.purchase', 'in', list(sub_ids)),
+                        ('account', '=', pending_invoice_account.id),
+                        ('reconciliation', '=', None),
+                        ])
+                to_reconcile = defaultdict(list)
+                for move_line in lines:
+                    to_reconcile[move_line.purchase_line.purchase].append(
+                        move_line)
+                if to_reconcile:
+                    MoveLine.reconcile(*to_reconcile.values(),
+                        writeoff=write_off, date=date)
+
+    @classmethod
+    def _post_stock_account_moves(cls, moves):
+        """
+        Post the moves in a single call sorted by company and date, so the
+        numbers of each company are reserved as one block from the sequence
+        and assigned in date order
+        """
+        pool = Pool()
+        Move = pool.get('account.move')
+
+        Move.post(sorted(moves, key=lambda m: (m.company.id, m.date, m.id)))
+
+    @classmethod
+    def _reconcile_stock_account_moves(cls, purchases, pending_invoice_account,
+            clear_cache=False):
+        """
+        Reconcile the pending invoice lines of each purchase if balanced.
+        The balanced purchases are selected in SQL and their lines are
+        loaded by slices of purchases, clearing the cache between them when
+        clear_cache is set.
+        """
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+        PurchaseLine = pool.get('purchase.line')
+        line = MoveLine.__table__()
+        purchase_line = PurchaseLine.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        balanced = []
+        for sub_purchases in grouped_slice(purchases):
+            cursor.execute(*line
+                .join(purchase_line,
+                    condition=line.purchase_line == purchase_line.id)
+                .select(purchase_line.purchase,
+                    where=(line.account == pending_invoice_account.id)
+                    & (line.reconciliation == Null)
+                    & reduce_ids(purchase_line.purchase,
+                        [p.id for p in sub_purchases]),
+                    group_by=purchase_line.purchase,
+                    having=Sum(line.debit - line.credit) == 0))
+            balanced.extend(p for p, in cursor)
+
+        for sub_ids in grouped_slice(sorted(balanced)):
+            # Revaluation moves have no purchase origin
+            lines = MoveLine.search([
+                    ('purchase_line.purchase', 'in', list(sub_ids)),
+                    ('account', '=', pending_invoice_account),
+                    ('reconciliation', '=', None),
+                    ])
+            purchase_lines = defaultdict(list)
+            for move_line in lines:
+                purchase_lines[move_line.purchase_line.purchase].append(
+                    move_line)
+            if purchase_lines:
+                MoveLine.reconcile(*purchase_lines.values())
+            if clear_cache:
+                for cache in transaction.cache.values():
+                    cache.clear()
+
+    def _get_stock_account_move(self, pending_invoice_account, lines=None,
+            expense_accounts=None, journal=None, periods=None, digests=None):
         "Return the account move for shipped quantities"
+        pool = Pool()
+        PurchaseLine = pool.get('purchase.line')
 
         if self.invoice_method in ['manual', 'order']:
             return
-        account_moves = []
-        for line in self.lines:
-            line_moves = line._get_stock_account_move_lines(
-                pending_invoice_account)
-            account_moves.extend(line_moves)
-        return account_moves
+        if lines is None:
+            line_ids = PurchaseLine._get_stock_account_move_line_ids([self])
+            lines = PurchaseLine.browse(line_ids.get(self.id, []))
+        if expense_accounts is None:
+            expense_accounts = {}
+        if journal is None:
+            journal = self._get_accounting_journal()
+        if periods is None:
+            periods = {}
+        return PurchaseLine._get_stock_account_moves_lines(
+            lines, pending_invoice_account, expense_accounts=expense_accounts,
+            journal=journal, periods=periods, digests=digests)
 
     def _get_accounting_journal(self):
         pool = Pool()
@@ -100,7 +789,17 @@ class PurchaseLine(metaclass=PoolMeta):
     __name__ = 'purchase.line'
 
     analytic_required = fields.Function(fields.Boolean("Require Analytics"),
-        'on_change_with_analytic_required')
+        'get_analytic_required')
+    stock_account_move_fingerprint = fields.Char(
+        "Stock Account Move Fingerprint", readonly=True,
+        help="Digest of the values used to compute the pending invoice "
+        "amounts the last time they were booked.")
+    stock_account_move_revaluation_date = fields.Date(
+        "Stock Account Move Revaluation Date", readonly=True,
+        help="The pending invoice amounts until this date are booked as a "
+        "whole at this date.\n"
+        "So an invoice posted later with an earlier accounting date is "
+        "booked at this date.")
 
     @classmethod
     def __setup__(cls):
@@ -114,6 +813,295 @@ class PurchaseLine(metaclass=PoolMeta):
             else:
                 cls.analytic_accounts.states['required'] = (
                     Eval('analytic_required', False))
+        if (cls._get_stock_account_move_lines
+                is not PurchaseLine._get_stock_account_move_lines):
+            warnings.warn(
+                "%s._get_stock_account_move_lines is no more called by the "
+                "booking, extend _get_pending_invoice_inputs or "
+                "_get_pending_invoice_move instead" % cls.__name__,
+                DeprecationWarning)
+
+    @classmethod
+    def copy(cls, lines, default=None):
+        if default is None:
+            default = {}
+        else:
+            default = default.copy()
+        default.setdefault('stock_account_move_fingerprint', None)
+        default.setdefault('stock_account_move_revaluation_date', None)
+        return super(PurchaseLine, cls).copy(lines, default=default)
+
+    @classmethod
+    def on_modification(cls, mode, lines, field_names=None):
+        super(PurchaseLine, cls).on_modification(
+            mode, lines, field_names=field_names)
+        if (mode == 'write' and 'unit_price' in field_names
+                and not Transaction().context.get('stock_account_move')):
+            cls._book_stock_account_move_price_change(lines)
+
+    @classmethod
+    def create_stock_account_moves(cls, lines):
+        """
+        Book the pending invoice amounts of the lines only, for the events
+        which change some lines without requiring a full purchase process
+        """
+        pool = Pool()
+        Purchase = pool.get('purchase.purchase')
+
+        if Transaction().context.get('stock_account_move') or not lines:
+            return
+        purchases = Purchase.browse(sorted({l.purchase.id for l in lines}))
+        Purchase.create_stock_account_moves(purchases, lines=lines)
+
+    @classmethod
+    def _get_stock_account_move_line_ids(cls, purchases):
+        """
+        Return a dictionary with the ids of the goods lines of each purchase
+        invoiced on shipment which have a done or cancelled stock move
+        """
+        pool = Pool()
+        Purchase = pool.get('purchase.purchase')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        StockMove = pool.get('stock.move')
+        line = cls.__table__()
+        purchase = Purchase.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+        move = StockMove.__table__()
+        cursor = Transaction().connection.cursor()
+
+        line_ids = defaultdict(list)
+        for sub_purchases in grouped_slice(purchases):
+            cursor.execute(*line
+                .join(purchase, condition=line.purchase == purchase.id)
+                .join(product, condition=line.product == product.id)
+                .join(template, condition=product.template == template.id)
+                .select(line.purchase, line.id,
+                    where=reduce_ids(line.purchase,
+                        [p.id for p in sub_purchases])
+                    & (purchase.invoice_method == 'shipment')
+                    & (template.type != 'service')
+                    & Exists(move.select(move.id,
+                            where=(move.origin == Concat(
+                                    cls.__name__ + ',', line.id))
+                            & move.state.in_(['done', 'cancelled']))),
+                    order_by=[line.purchase, line.id]))
+            for purchase_id, line_id in cursor:
+                line_ids[purchase_id].append(line_id)
+        return line_ids
+
+    @classmethod
+    def audit_pending_invoice(cls, company):
+        """
+        Yield (line id, expected, booked) for each purchase line of company
+        whose booked pending invoice balance differs from the amount of its
+        invoice lines not yet posted.
+        The quantities of each accounting date are read in SQL and valued
+        with the same unit conversion and rounding per date as the booking,
+        so companies can be audited in parallel. The amounts of the foreign
+        currency purchases are converted at the rate of each date.
+        """
+        pool = Pool()
+        Config = pool.get('purchase.configuration')
+        Company = pool.get('company.company')
+        Currency = pool.get('currency.currency')
+        Purchase = pool.get('purchase.purchase')
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        line = cls.__table__()
+        purchase = Purchase.__table__()
+        move = Move.__table__()
+        move_line = MoveLine.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        company = Company(company)
+        with transaction.set_context(company=company.id):
+            pending_invoice_account = Config(1).pending_invoice_account
+        if not pending_invoice_account:
+            return
+
+        # Lines of the purchases invoiced on shipment
+        lines = (line
+            .join(purchase, condition=line.purchase == purchase.id)
+            .select(line.id, line.unit, line.unit_price,
+                line.stock_account_move_revaluation_date,
+                purchase.currency,
+                where=(purchase.company == company.id)
+                & (purchase.invoice_method == 'shipment')))
+
+        booked = {}
+        cursor.execute(*move_line
+            .join(move, condition=move_line.move == move.id)
+            .join(lines, condition=move_line.purchase_line == lines.id)
+            .select(move_line.purchase_line,
+                Sum(move_line.credit - move_line.debit),
+                where=(move_line.account == pending_invoice_account.id)
+                & (move.company == company.id),
+                group_by=move_line.purchase_line))
+        for line_id, amount in cursor:
+            booked[line_id] = Decimal(str(amount))
+
+        cursor.execute(*lines.select(lines.id, lines.currency,
+                where=lines.currency != company.currency.id))
+        currencies = dict(cursor)
+        rates = {}
+
+        def convert(amount, currency_id, date):
+            key = (currency_id, date)
+            if key not in rates:
+                with transaction.set_context(date=date):
+                    # Raise the missing rate error like the booking
+                    Currency.compute(currency_id, _ZERO, company.currency)
+                    rates[key] = (
+                        Currency(company.currency.id).rate,
+                        Currency(currency_id).rate)
+            to_rate, from_rate = rates[key]
+            return amount * to_rate / from_rate
+
+        for line_id, unit_price, revaluation_date, quantities in (
+                cls._get_pending_invoice_quantities(company, lines)):
+            if revaluation_date:
+                quantities = _merge_until(quantities, revaluation_date)
+            currency_id = currencies.get(line_id)
+            expected = _ZERO
+            for date, quantity in quantities.items():
+                amount = quantity * (unit_price or _ZERO)
+                if currency_id:
+                    amount = convert(amount, currency_id, date)
+                expected += company.currency.round(amount)
+            booked_amount = booked.pop(line_id, _ZERO)
+            if expected != booked_amount:
+                yield line_id, expected, booked_amount
+        # Booked lines without invoice line
+        for line_id, booked_amount in sorted(booked.items()):
+            if booked_amount:
+                yield line_id, _ZERO, booked_amount
+
+    @classmethod
+    def _get_pending_invoice_quantities(cls, company, lines):
+        """
+        Yield (line id, unit price, revaluation date, quantities) for each
+        line of the lines query with invoice lines, where quantities maps each
+        accounting date to the quantity pending to invoice like
+        _get_pending_quantities.
+        The lines query must have the id, unit, unit_price and
+        stock_account_move_revaluation_date columns.
+        The invoice lines without stock move nor invoice are dated like the
+        booking with the delivery date of the line or the purchase date.
+        """
+        pool = Pool()
+        Purchase = pool.get('purchase.purchase')
+        InvoiceLine = pool.get('account.invoice.line')
+        Invoice = pool.get('account.invoice')
+        StockMove = pool.get('stock.move')
+        Uom = pool.get('product.uom')
+        invoice_line = InvoiceLine.__table__()
+        invoice = Invoice.__table__()
+        stock_move = StockMove.__table__()
+        ignored_field = Purchase.invoice_lines_ignored
+        ignored = pool.get(ignored_field.relation_name).__table__()
+        invoice_move = pool.get(
+            InvoiceLine.stock_moves.relation_name).__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        # The first stock move of the invoice line has the highest id
+        last_move = (invoice_move
+            .select(invoice_move.invoice_line,
+                Max(invoice_move.stock_move).as_('stock_move'),
+                group_by=invoice_move.invoice_line))
+        receipt_date = Case(
+            (last_move.stock_move != Null, stock_move.effective_date),
+            (invoice.id != Null, invoice.invoice_date),
+            else_=Null)
+        undated = (last_move.stock_move == Null) & (invoice.id == Null)
+        reversal_date = Case(
+            (invoice.state.in_(['posted', 'paid']),
+                Coalesce(invoice.accounting_date, invoice.invoice_date)),
+            else_=Null)
+        cursor.execute(*invoice_line
+            .join(lines, condition=invoice_line.origin == Concat(
+                    cls.__name__ + ',', lines.id))
+            .join(last_move, 'LEFT',
+                condition=last_move.invoice_line == invoice_line.id)
+            .join(stock_move, 'LEFT',
+                condition=last_move.stock_move == stock_move.id)
+            .join(invoice, 'LEFT',
+                condition=invoice_line.invoice == invoice.id)
+            .select(lines.id, lines.unit, lines.unit_price,
+                lines.stock_account_move_revaluation_date,
+                invoice_line.unit, invoice_line.quantity,
+                receipt_date, reversal_date, undated,
+                where=(invoice_line.company == company.id)
+                & ~invoice_line.id.in_(ignored.select(
+                        Column(ignored, ignored_field.target))),
+                order_by=lines.id))
+
+        current = None
+        while True:
+            rows = cursor.fetchmany(transaction.database.IN_MAX)
+            if not rows:
+                break
+            for (line_id, unit, unit_price, revaluation_date, invoice_unit,
+                    quantity, date, reversal_date, undated) in rows:
+                if current and current[0] != line_id:
+                    yield current
+                    current = None
+                if current is None:
+                    current = (line_id, unit_price, revaluation_date, {})
+                if undated:
+                    # The delivery date depends on the stock moves and the
+                    # supplier lead time
+                    line = cls(line_id)
+                    date = line.delivery_date or line.purchase.purchase_date
+                if not date:
+                    continue
+                unit = Uom(unit)
+                quantity = Decimal(str(Uom.compute_qty(
+                            Uom(invoice_unit), quantity, unit))).quantize(
+                    Decimal(1).scaleb(-unit.digits))
+                quantities = current[-1]
+                quantities[date] = quantities.get(date, _ZERO) + quantity
+                if reversal_date:
+                    quantities[reversal_date] = (
+                        quantities.get(reversal_date, _ZERO) - quantity)
+        if current:
+            yield current
+
+    @property
+    def _expense_account_key(self):
+        return (self.product.id if self.product else None,
+            self.company.id if self.company else None)
+
+    @classmethod
+    def _get_expense_accounts(cls, lines):
+        """
+        Return a dictionary with the expense account used by each product
+        and company of the lines, resolving each couple only once
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+
+        accounts = {}
+        for line in lines:
+            key = line._expense_account_key
+            product_id, company_id = key
+            if product_id is None or key in accounts:
+                continue
+            with Transaction().set_context(company=company_id):
+                accounts[key] = Product(product_id).account_expense_used
+        return accounts
+
+    @classmethod
+    def get_analytic_required(cls, lines, name):
+        if not hasattr(cls, 'analytic_accounts'):
+            return {l.id: False for l in lines}
+        accounts = cls._get_expense_accounts(lines)
+        return {l.id: bool(getattr(accounts.get(l._expense_account_key),
+                    'analytic_required', False))
+            for l in lines}
 
     @fields.depends('product')
     def on_change_with_analytic_required(self, name=None):
@@ -125,23 +1113,206 @@ class PurchaseLine(metaclass=PoolMeta):
             return True
         return False
 
-    def _get_stock_account_move_lines(self, pending_invoice_account):
+    @classmethod
+    def _get_stock_account_move_states(cls, lines, pending_invoice_account):
         """
-        Return the account move lines for shipped quantities and
-        to reconcile shipped and invoiced (and posted) quantities
+        Return for each line a marker of its booked pending invoice lines and
+        of the rates of its currencies, so the fingerprint changes when a
+        booked move is cancelled or deleted or when a rate is corrected.
+        Only the rates dated until the last accounting date of the line are
+        marked, as the later ones do not value any of its amounts.
+        """
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+        Rate = pool.get('currency.currency.rate')
+        move_line = MoveLine.__table__()
+        rate = Rate.__table__()
+        cursor = Transaction().connection.cursor()
+
+        booked = {}
+        if pending_invoice_account:
+            for sub_lines in grouped_slice(lines):
+                cursor.execute(*move_line.select(
+                        move_line.purchase_line, Count(Literal('*')),
+                        Sum(move_line.credit - move_line.debit),
+                        Max(move_line.id),
+                        where=reduce_ids(move_line.purchase_line,
+                            [l.id for l in sub_lines])
+                        & (move_line.account == pending_invoice_account.id),
+                        group_by=move_line.purchase_line))
+                for line_id, count, amount, max_id in cursor:
+                    booked[line_id] = _booked_state(count, amount, max_id)
+
+        currencies = {}
+        for line in lines:
+            if line.purchase.currency != line.company.currency:
+                currencies[line.id] = (
+                    line.purchase.currency.id, line.company.currency.id)
+        last_dates = cls._get_stock_account_move_last_dates(
+            [l for l in lines if l.id in currencies])
+
+        # The cumulated count and last modification of the rates by date
+        rates = defaultdict(lambda: ([], []))
+        currency_ids = sorted({c for cs in currencies.values() for c in cs})
+        for sub_ids in grouped_slice(currency_ids):
+            cursor.execute(*rate.select(
+                    rate.currency, rate.date,
+                    Coalesce(rate.write_date, rate.create_date),
+                    where=reduce_ids(rate.currency, sub_ids),
+                    order_by=[rate.currency, rate.date]))
+            for currency_id, date, timestamp in cursor:
+                dates, markers = rates[currency_id]
+                if markers:
+                    count, last = markers[-1]
+                    timestamp = max(last, timestamp)
+                else:
+                    count = 0
+                dates.append(date)
+                markers.append((count + 1, timestamp))
+
+        def rate_state(currency_id, date):
+            dates, markers = rates.get(currency_id, ([], []))
+            index = bisect_right(dates, date) if date else len(dates)
+            return markers[index - 1] if index else None
+
+        return {l.id: (booked.get(l.id),
+                tuple(rate_state(c, last_dates.get(l.id))
+                    for c in currencies.get(l.id, ())))
+            for l in lines}
+
+    @classmethod
+    def _get_stock_account_move_last_dates(cls, lines):
+        """
+        Return for each line the last accounting date of its pending
+        invoice quantities or None when it is unknown
+        """
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
+        StockMove = pool.get('stock.move')
+        invoice = Invoice.__table__()
+        invoice_line = InvoiceLine.__table__()
+        stock_move = StockMove.__table__()
+        cursor = Transaction().connection.cursor()
+
+        dates = defaultdict(list)
+        for line in lines:
+            dates[str(line)].extend(
+                [line.delivery_date, line.purchase.purchase_date])
+        for sub_origins in grouped_slice(list(dates)):
+            sub_origins = list(sub_origins)
+            cursor.execute(*stock_move.select(
+                    stock_move.origin, Max(stock_move.effective_date),
+                    where=stock_move.origin.in_(sub_origins),
+                    group_by=stock_move.origin))
+            for origin, date in cursor:
+                dates[origin].append(date)
+            cursor.execute(*invoice_line
+                .join(invoice, condition=invoice_line.invoice == invoice.id)
+                .select(invoice_line.origin, Max(invoice.invoice_date),
+                    Max(invoice.accounting_date),
+                    where=invoice_line.origin.in_(sub_origins),
+                    group_by=invoice_line.origin))
+            for origin, invoice_date, accounting_date in cursor:
+                dates[origin].extend([invoice_date, accounting_date])
+        return {l.id: max(filter(None, dates[str(l)]), default=None)
+            for l in lines}
+
+    @classmethod
+    def _set_stock_account_move_fingerprints(
+            cls, lines, pending_invoice_account, digests=None, moves=None):
+        """
+        Store the fingerprint of the lines once their amounts are booked.
+        digests maps the lines checked by _get_pending_invoice_inputs to
+        their state and digest before the moves were booked, so only the
+        states of the other lines are read again.
+        """
+        if digests is None:
+            digests = {}
+        states = cls._get_stock_account_move_states(
+            [l for l in lines if l.id not in digests],
+            pending_invoice_account)
+        booked = defaultdict(list)
+        for move in moves or []:
+            for move_line in move.lines:
+                if move_line.account == pending_invoice_account:
+                    booked[move_line.purchase_line.id].append(move_line)
+        to_save = []
+        for line in lines:
+            if line.id in digests:
+                state, digest = digests[line.id]
+                booked_state, rate_state = state
+                for move_line in booked.get(line.id, []):
+                    count, amount, max_id = booked_state or (0, '0', 0)
+                    booked_state = _booked_state(count + 1,
+                        Decimal(amount)
+                        + move_line.credit - move_line.debit,
+                        max(max_id, move_line.id))
+                fingerprint = line._get_stock_account_move_fingerprint(
+                    (booked_state, rate_state), digest=digest)
+            else:
+                fingerprint = line._get_stock_account_move_fingerprint(
+                    states[line.id])
+            if fingerprint != line.stock_account_move_fingerprint:
+                line.stock_account_move_fingerprint = fingerprint
+                to_save.append(line)
+        cls.save(to_save)
+
+    def _get_stock_account_move_fingerprint(self, state=None, digest=None):
+        """
+        Return a digest of the booked state returned by
+        _get_stock_account_move_states and of the digest of the inputs
+        """
+        if digest is None:
+            digest = self._get_stock_account_move_digest()
+        return hashlib.sha256(
+            repr((state, digest)).encode('utf-8')).hexdigest()
+
+    def _get_stock_account_move_digest(self):
+        """
+        Return a digest of the stock moves, invoice lines, unit price and
+        currency which the pending invoice amounts are computed from
+        """
+        ignored = set(self.purchase.invoice_lines_ignored)
+        values = [
+            self.unit_price,
+            self.unit.id if self.unit else None,
+            self.purchase.currency.id,
+            self.delivery_date,
+            self.purchase.purchase_date,
+            self.stock_account_move_revaluation_date,
+            ]
+        for move in self.moves:
+            values.append((move.id, move.state, move.quantity,
+                    move.unit.id, move.effective_date))
+        for invoice_line in self.invoice_lines:
+            invoice = invoice_line.invoice
+            values.append((invoice_line.id, invoice_line.quantity,
+                    invoice_line.unit.id if invoice_line.unit else None,
+                    tuple(m.id for m in invoice_line.stock_moves),
+                    invoice_line in ignored,
+                    invoice.state if invoice else None,
+                    invoice.invoice_date if invoice else None,
+                    invoice.accounting_date if invoice else None))
+        return hashlib.sha256(repr(values).encode('utf-8')).hexdigest()
+
+    def _get_pending_quantity(self, unit, quantity):
+        """
+        Return quantity converted to the line unit as a Decimal rounded to
+        the unit digits, so accumulated quantities do not leave float residue
         """
         pool = Pool()
         Uom = pool.get('product.uom')
-        AccountMoveLine = pool.get('account.move.line')
-        AccountMove = pool.get('account.move')
-        Currency = pool.get('currency.currency')
-        Period = pool.get('account.period')
 
-        if (not self.product or self.product.type == 'service' or
-                not self.moves):
-            # Purchase Line not shipped
-            return []
+        quantity = Uom.compute_qty(unit, quantity, self.unit)
+        return Decimal(str(quantity)).quantize(
+            Decimal(1).scaleb(-self.unit.digits))
 
+    def _get_pending_quantities(self):
+        """
+        Return a dictionary with the quantity pending to invoice at each
+        accounting date
+        """
         quantities = {}
         for invoice_line in self.invoice_lines:
             if invoice_line in self.purchase.invoice_lines_ignored:
@@ -155,10 +1326,10 @@ class PurchaseLine(metaclass=PoolMeta):
             if not accounting_date:
                 continue
 
-            quantity = Uom.compute_qty(
-                    invoice_line.unit, invoice_line.quantity, self.unit)
+            quantity = self._get_pending_quantity(
+                invoice_line.unit, invoice_line.quantity)
             if accounting_date not in quantities:
-                quantities[accounting_date] = 0.0
+                quantities[accounting_date] = _ZERO
             quantities[accounting_date] += quantity
             if ((invoice_line.invoice
                     and invoice_line.invoice.state in ['posted', 'paid'])):
@@ -167,13 +1338,139 @@ class PurchaseLine(metaclass=PoolMeta):
                     or invoice_line.invoice.invoice_date
                     or invoice_line.invoice.write_date.date()
                     )
-                quantity = Uom.compute_qty(
-                        invoice_line.unit, invoice_line.quantity, self.unit)
                 if accounting_date not in quantities:
-                    quantities[accounting_date] = 0.0
+                    quantities[accounting_date] = _ZERO
                 quantities[accounting_date] -= quantity
+        return quantities
+
+    def _get_stock_account_move_lines(self, pending_invoice_account,
+            expense_account=None, journal=None, periods=None):
+        """
+        Return the account move lines for shipped quantities and
+        to reconcile shipped and invoiced (and posted) quantities
+
+        Deprecated: the booking values the lines in batch with
+        _get_stock_account_moves_lines which calls the per line steps
+        _get_pending_invoice_inputs and _get_pending_invoice_move.
+        """
+        warnings.warn(
+            "_get_stock_account_move_lines is deprecated, "
+            "use _get_stock_account_moves_lines",
+            DeprecationWarning, stacklevel=2)
+        expense_accounts = {}
+        if expense_account is not None:
+            expense_accounts[self._expense_account_key] = expense_account
+        return self._get_stock_account_moves_lines(
+            [self], pending_invoice_account,
+            expense_accounts=expense_accounts, journal=journal,
+            periods=periods)
+
+    @classmethod
+    def _get_stock_account_moves_lines(cls, lines, pending_invoice_account,
+            expense_accounts=None, journal=None, periods=None, digests=None):
+        """
+        Return the account moves for shipped quantities and to reconcile
+        shipped and invoiced (and posted) quantities of all the lines.
+        The expense accounts are resolved into expense_accounts only for the
+        lines with an amount to book and the digests of the checked lines
+        are stored in digests.
+        """
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+
+        if expense_accounts is None:
+            expense_accounts = {}
+        transaction = Transaction()
+        states = cls._get_stock_account_move_states(
+            lines, pending_invoice_account)
+        columns = defaultdict(lambda: ([], [], [], [], [], {}))
+        rates = {}
+        records = {}
+        for line in lines:
+            inputs = line._get_pending_invoice_inputs(
+                pending_invoice_account, state=states[line.id],
+                digests=digests)
+            if inputs is None:
+                continue
+            records[line.id] = line
+            quantities, booked = inputs
+            from_currency = line.purchase.currency
+            to_currency = line.purchase.company.currency
+            line_ids, dates, line_quantities, prices, line_rates, \
+                line_booked = columns[to_currency]
+            for date, quantity in quantities.items():
+                rate = None
+                if from_currency != to_currency:
+                    key = (from_currency.id, to_currency.id, date)
+                    if key not in rates:
+                        with transaction.set_context(date=date):
+                            # Raise the missing rate error
+                            Currency.compute(from_currency, _ZERO, to_currency)
+                            rates[key] = (
+                                Currency(to_currency.id).rate,
+                                Currency(from_currency.id).rate)
+                    rate = rates[key]
+                line_ids.append(line.id)
+                dates.append(date)
+                line_quantities.append(quantity)
+                prices.append(line.unit_price)
+                line_rates.append(rate)
+            line_booked.update(
+                ((line.id, d), v) for d, v in booked.items())
+
+        moves = []
+        for currency, (line_ids, dates, quantities, prices, line_rates,
+                booked) in columns.items():
+            for line_id, date, pending_amount, purchase_quantity in (
+                    _compute_pending_amounts(
+                        line_ids, dates, quantities, prices, line_rates,
+                        booked, currency.round)):
+                line = records[line_id]
+                key = line._expense_account_key
+                if key not in expense_accounts:
+                    expense_accounts.update(cls._get_expense_accounts([line]))
+                moves.append(line._get_pending_invoice_move(
+                        date, pending_amount, purchase_quantity,
+                        pending_invoice_account,
+                        expense_account=expense_accounts.get(
+                            line._expense_account_key),
+                        journal=journal, periods=periods))
+        return moves
+
+    def _get_pending_invoice_inputs(self, pending_invoice_account,
+            state=None, digests=None):
+        """
+        Return the quantities pending to invoice by date and the booked
+        (amount, quantity) by date or None if there is nothing to book.
+        The lines whose fingerprint is unchanged are skipped unless the
+        stock_account_move_recompute context key is set.
+        The state and the digest of the checked line are stored in digests.
+        """
+        pool = Pool()
+        AccountMoveLine = pool.get('account.move.line')
+
+        if (not self.product or self.product.type == 'service' or
+                not self.moves):
+            # Purchase Line not shipped
+            return
+
+        digest = self._get_stock_account_move_digest()
+        if digests is not None:
+            digests[self.id] = (state, digest)
+        fingerprint = self._get_stock_account_move_fingerprint(
+            state, digest=digest)
+        if (fingerprint == self.stock_account_move_fingerprint
+                and not Transaction().context.get(
+                    'stock_account_move_recompute')):
+            # Nothing changed since the last time amounts were booked
+            return
+
+        quantities = self._get_pending_quantities()
 
         amounts = {}
+        recorded_quantities = defaultdict(float)
+        # The quantity of the lines booked before it was recorded is unknown
+        unknown_quantities = set()
         move_lines = AccountMoveLine.search([
             ('purchase_line', '=', self),
             ('account', '=', pending_invoice_account),
@@ -183,82 +1480,516 @@ class PurchaseLine(metaclass=PoolMeta):
             if move_line_date not in amounts:
                 amounts[move_line_date] = _ZERO
             amounts[move_line_date] += (move_line.credit - move_line.debit)
+            if move_line.purchase_quantity is None:
+                unknown_quantities.add(move_line_date)
+            else:
+                recorded_quantities[move_line_date] += (
+                    move_line.purchase_quantity)
+
+        revaluation_date = self.stock_account_move_revaluation_date
+        if revaluation_date:
+            # Amounts until the revaluation have been booked as a whole
+            quantities = _merge_until(quantities, revaluation_date)
+            amounts = _merge_until(amounts, revaluation_date)
+            recorded_quantities = defaultdict(float,
+                _merge_until(recorded_quantities, revaluation_date))
+            unknown_quantities = {
+                max(d, revaluation_date) for d in unknown_quantities}
+
+        booked = {
+            d: (a, None if d in unknown_quantities else recorded_quantities[d])
+            for d, a in amounts.items()}
+        return quantities, booked
+
+    def _get_pending_invoice_move(self, date, pending_amount,
+            purchase_quantity, pending_invoice_account, expense_account=None,
+            journal=None, periods=None):
+        "Return the account move booking pending_amount at date"
+        pool = Pool()
+        AccountMoveLine = pool.get('account.move.line')
+        AccountMove = pool.get('account.move')
+        Period = pool.get('account.period')
+
+        if expense_account is None:
+            expense_account = self.product.account_expense_used
+        move_lines = []
+        move_line = AccountMoveLine()
+        move_line.account = expense_account
+        if move_line.account.party_required:
+            move_line.party = self.purchase.party
+        move_line.purchase_line = self
+        move_line.purchase_quantity = purchase_quantity
+        if pending_amount < _ZERO:
+            move_line.credit = abs(pending_amount)
+            move_line.debit = _ZERO
+        else:
+            move_line.debit = pending_amount
+            move_line.credit = _ZERO
+        self._set_analytic_lines(move_line)
+        move_lines.append(move_line)
+
+        move_line = AccountMoveLine()
+        move_line.account = pending_invoice_account
+        if move_line.account.party_required:
+            move_line.party = self.purchase.party
+        move_line.purchase_line = self
+        move_line.purchase_quantity = purchase_quantity
+        if pending_amount > _ZERO:
+            move_line.credit = pending_amount
+            move_line.debit = _ZERO
+        else:
+            move_line.debit = abs(pending_amount)
+            move_line.credit = _ZERO
+        move_lines.append(move_line)
+
+        if journal is None:
+            journal = self.purchase._get_accounting_journal()
+        if periods is None:
+            periods = {}
+        key = (self.company.id, date)
+        if key not in periods:
+            periods[key] = Period.find(self.company.id, date=date)
+        return AccountMove(
+            origin=self.purchase,
+            period=periods[key],
+            journal=journal,
+            date=date,
+            lines=move_lines,)
+
+    @classmethod
+    def _book_stock_account_move_price_change(cls, lines):
+        """
+        Book a single move per received line at today for the difference
+        between its booked pending balance and the pending quantity valued at
+        the new unit price, instead of correcting every past date.
+        The line is then valued as a whole until today, so any later booking
+        of an earlier accounting date, like the reversal of an invoice, is
+        dated today. The amounts booked after today are left to the next
+        process.
+        """
+        pool = Pool()
+        Config = pool.get('purchase.configuration')
+        Currency = pool.get('currency.currency')
+        Date = pool.get('ir.date')
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        Purchase = pool.get('purchase.purchase')
+        move_line = MoveLine.__table__()
+        move = Move.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        purchases = Purchase.browse(sorted({l.purchase.id for l in lines}))
+        line_ids = cls._get_stock_account_move_line_ids(purchases)
+        eligible = {i for ids in line_ids.values() for i in ids}
+        lines = [l for l in lines if l.id in eligible]
+
+        def keyfunc(line):
+            return line.company.id
+        lines = sorted(lines, key=keyfunc)
+        for company_id, c_lines in groupby(lines, key=keyfunc):
+            c_lines = list(c_lines)
+            with transaction.set_context(company=company_id,
+                    _check_access=False):
+                pending_invoice_account = Config(1).pending_invoice_account
+                if not pending_invoice_account:
+                    continue
+                date = Date.today()
+
+                booked = {}
+                for sub_lines in grouped_slice(c_lines):
+                    cursor.execute(*move_line
+                        .join(move, condition=move_line.move == move.id)
+                        .select(move_line.purchase_line,
+                            Sum(Case((move.date <= date,
+                                        move_line.credit - move_line.debit),
+                                    else_=_ZERO)),
+                            Sum(Case((move.date > date, 1), else_=0)),
+                            where=reduce_ids(move_line.purchase_line,
+                                [l.id for l in sub_lines])
+                            & (move_line.account
+                                == pending_invoice_account.id),
+                            group_by=move_line.purchase_line))
+                    for line_id, amount, later in cursor:
+                        booked[line_id] = (Decimal(str(amount)), later)
+
+                moves = []
+                periods = {}
+                to_fingerprint = []
+                for line in c_lines:
+                    if line.id not in booked:
+                        continue
+                    amount, later = booked[line.id]
+                    quantities = line._get_pending_quantities()
+                    quantity = sum((q for d, q in quantities.items()
+                            if d <= date), _ZERO)
+                    with transaction.set_context(date=date):
+                        expected = Currency.compute(line.purchase.currency,
+                            quantity * line.unit_price,
+                            line.purchase.company.currency)
+                    if expected != amount:
+                        moves.append(line._get_pending_invoice_move(
+                                date, expected - amount, 0.0,
+                                pending_invoice_account, periods=periods))
+                    line.stock_account_move_revaluation_date = date
+                    if not later and all(d <= date for d in quantities):
+                        # Nothing is booked after the change
+                        to_fingerprint.append(line)
+                if moves:
+                    Move.save(moves)
+                    Purchase._post_stock_account_moves(moves)
+                cls.save(c_lines)
+                cls._set_stock_account_move_fingerprints(
+                    to_fingerprint, pending_invoice_account)
+
+    @classmethod
+    def revalue_pending_invoice(cls, date):
+        """
+        Revalue at the rate of date the open pending invoice balance until
+        date of the lines of foreign currency purchases of the context
+        company.
+        Return one posted move per currency with a line per purchase line
+        and the currency exchange difference.
+        """
+        pool = Pool()
+        AccountConfig = pool.get('account.configuration')
+        Company = pool.get('company.company')
+        Config = pool.get('purchase.configuration')
+        Currency = pool.get('currency.currency')
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        Period = pool.get('account.period')
+        Purchase = pool.get('purchase.purchase')
+        move_line = MoveLine.__table__()
+        move = Move.__table__()
+        line = cls.__table__()
+        purchase = Purchase.__table__()
+        company_table = Company.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        company = Company(transaction.context['company'])
+        pending_invoice_account = Config(1).pending_invoice_account
+        if not pending_invoice_account:
+            return []
+        account_config = AccountConfig(1)
+
+        # Open pending invoice lines of the foreign currency purchases
+        revaluation_date = line.stock_account_move_revaluation_date
+        open_lines = (move_line
+            .join(move, condition=move_line.move == move.id)
+            .join(line, condition=move_line.purchase_line == line.id)
+            .join(purchase, condition=line.purchase == purchase.id)
+            .join(company_table,
+                condition=purchase.company == company_table.id)
+            .select(line.id.as_('id'), purchase.currency.as_('currency'),
+                Sum(move_line.credit - move_line.debit).as_('amount'),
+                where=(move_line.account == pending_invoice_account.id)
+                & (move_line.reconciliation == Null)
+                & (move.company == company.id)
+                & (move.date <= date)
+                & (purchase.invoice_method == 'shipment')
+                & (purchase.currency != company_table.currency)
+                & ((revaluation_date == Null) | (revaluation_date <= date)),
+                group_by=[line.id, purchase.currency]))
+        cursor.execute(*open_lines.select(
+                open_lines.id, open_lines.currency, open_lines.amount))
+        booked = {}
+        for line_id, currency_id, amount in cursor:
+            booked[line_id] = (currency_id, Decimal(str(amount)))
+
+        lines = line.select(line.id, line.unit, line.unit_price,
+            line.stock_account_move_revaluation_date,
+            where=line.id.in_(open_lines.select(open_lines.id)))
+        unit_prices = {}
+        quantities = defaultdict(lambda: _ZERO)
+        for line_id, unit_price, _, line_quantities in (
+                cls._get_pending_invoice_quantities(company, lines)):
+            unit_prices[line_id] = unit_price or _ZERO
+            quantities[line_id] = sum((q for d, q in line_quantities.items()
+                    if d <= date), _ZERO)
+
+        with transaction.set_context(date=date):
+            currencies = Currency.browse(
+                {c for c, _ in booked.values()} | {company.currency.id})
+            # Raise for the currencies without rate at date
+            for currency in currencies:
+                Currency.compute(currency, _ZERO, company.currency)
+            rates = {c.id: c.rate for c in currencies}
+        differences = defaultdict(list)
+        for line_id, (currency_id, amount) in sorted(booked.items()):
+            expected = company.currency.round(
+                quantities[line_id] * unit_prices.get(line_id, _ZERO)
+                * rates[company.currency.id] / rates[currency_id])
+            difference = expected - amount
+            if difference:
+                differences[currency_id].append((line_id, difference))
+        for sub_ids in grouped_slice(sorted(booked)):
+            cls.write(cls.browse(sub_ids), {
+                    'stock_account_move_revaluation_date': date,
+                    })
+
+        if not differences:
+            return []
+        journal = account_config.get_multivalue(
+            'currency_exchange_journal', company=company.id)
+        if not journal:
+            raise UserError(gettext('purchase_stock_account_move.'
+                    'msg_revaluation_currency_exchange_journal_missing',
+                    company=company.rec_name))
 
         moves = []
-        for date in sorted(list(set(quantities.keys()) | set(amounts.keys()))):
+        period = Period.find(company.id, date=date)
+        for currency_id, c_differences in sorted(differences.items()):
+            currency = Currency(currency_id)
             move_lines = []
-            pending_quantity = quantities.get(date, 0.0)
-            recorded_pending_amount = amounts.get(date, _ZERO)
-
-            with Transaction().set_context(date=date):
-                pending_amount = (Currency.compute(self.purchase.currency,
-                        Decimal(pending_quantity) * self.unit_price,
-                        self.purchase.company.currency) - recorded_pending_amount)
-
-            if pending_amount:
-                move_line = AccountMoveLine()
-                move_line.account = self.product.account_expense_used
-                if move_line.account.party_required:
-                    move_line.party = self.purchase.party
-                move_line.purchase_line = self
-                if pending_amount < _ZERO:
-                    move_line.credit = abs(pending_amount)
-                    move_line.debit = _ZERO
+            total = _ZERO
+            for line, difference in zip(
+                    cls.browse([l for l, _ in c_differences]),
+                    (d for _, d in c_differences)):
+                pending_line = MoveLine(
+                    account=pending_invoice_account,
+                    purchase_line=line,
+                    purchase_quantity=0.0,
+                    debit=abs(difference) if difference < 0 else _ZERO,
+                    credit=difference if difference > 0 else _ZERO)
+                if pending_invoice_account.party_required:
+                    pending_line.party = line.purchase.party
+                move_lines.append(pending_line)
+                total += difference
+            if total:
+                if total > 0:
+                    account = account_config.get_multivalue(
+                        'currency_exchange_debit_account', company=company.id)
+                    if not account:
+                        raise UserError(gettext(
+                                'purchase_stock_account_move.'
+                                'msg_revaluation_currency_exchange_'
+                                'debit_account_missing',
+                                company=company.rec_name))
                 else:
-                    move_line.debit = pending_amount
-                    move_line.credit = _ZERO
-                self._set_analytic_lines(move_line)
-                move_lines.append(move_line)
-
-                move_line = AccountMoveLine()
-                move_line.account = pending_invoice_account
-                if move_line.account.party_required:
-                    move_line.party = self.purchase.party
-                move_line.purchase_line = self
-                if pending_amount > _ZERO:
-                    move_line.credit = pending_amount
-                    move_line.debit = _ZERO
-                else:
-                    move_line.debit = abs(pending_amount)
-                    move_line.credit = _ZERO
-                move_lines.append(move_line)
-            if move_lines:
-                period_id = Period.find(self.company.id, date=date)
-                move = AccountMove(
-                    origin=self.purchase,
-                    period=period_id,
-                    journal=self.purchase._get_accounting_journal(),
+                    account = account_config.get_multivalue(
+                        'currency_exchange_credit_account',
+                        company=company.id)
+                    if not account:
+                        raise UserError(gettext(
+                                'purchase_stock_account_move.'
+                                'msg_revaluation_currency_exchange_'
+                                'credit_account_missing',
+                                company=company.rec_name))
+                move_lines.append(MoveLine(
+                        account=account,
+                        debit=total if total > 0 else _ZERO,
+                        credit=abs(total) if total < 0 else _ZERO))
+            moves.append(Move(
+                    company=company,
+                    period=period,
+                    journal=journal,
                     date=date,
-                    lines=move_lines,)
-                moves.append(move)
+                    description=currency.code,
+                    lines=move_lines))
+        Move.save(moves)
+        Purchase._post_stock_account_moves(moves)
         return moves
 
-    def _set_analytic_lines(self, move_line):
-        """
-        Add to supplied account move line analytic lines based on purchase line
-        analytic accounts value
-        """
+
+class StockAccountMoveError(ModelSQL, ModelView):
+    'Purchase Stock Account Move Error'
+    __name__ = 'purchase.stock_account_move.error'
+
+    purchase = fields.Many2One('purchase.purchase', 'Purchase',
+        required=True, readonly=True, ondelete='CASCADE')
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True, ondelete='CASCADE')
+    message = fields.Text('Message', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(StockAccountMoveError, cls).__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+
+
+class PendingInvoiceBalance(ModelSQL, ModelView):
+    'Pending Invoice Balance'
+    __name__ = 'purchase.pending_invoice.balance'
+
+    party = fields.Many2One('party.party', 'Party', readonly=True)
+    purchase = fields.Many2One('purchase.purchase', 'Purchase',
+        readonly=True)
+    product = fields.Many2One('product.product', 'Product', readonly=True)
+    company = fields.Many2One('company.company', 'Company', readonly=True)
+    currency = fields.Function(fields.Many2One(
+            'currency.currency', 'Currency'), 'get_currency')
+    balance = Monetary('Balance', currency='currency', digits='currency',
+        readonly=True,
+        help="The amount received and pending to be invoiced.")
+
+    @classmethod
+    def table_query(cls):
         pool = Pool()
         Date = pool.get('ir.date')
+        MoveLine = pool.get('account.move.line')
+        context = Transaction().context
 
-        if (not getattr(self, 'analytic_accounts', False) or
-                not self.analytic_accounts):
-            return
+        return MoveLine._get_pending_invoice_balance_query(
+            context.get('company'),
+            context.get('date') or Date.today(),
+            context.get('grouping') or 'party')
+
+    def get_currency(self, name):
+        return self.company.currency.id
 
-        AnalyticLine = pool.get('analytic_account.line')
-        move_line.analytic_lines = []
-        for account in self.analytic_accounts:
-            line = AnalyticLine()
-            move_line.analytic_lines += (line,)
-            line.debit = move_line.debit
-            line.credit = move_line.credit
-            line.account = account.account
-            line.date = Date.today()
 
+class PendingInvoiceBalanceContext(ModelView):
+    'Pending Invoice Balance Context'
+    __name__ = 'purchase.pending_invoice.balance.context'
 
-class HandleShipmentException(metaclass=PoolMeta):
-    __name__ = 'purchase.handle.shipment.exception'
+    company = fields.Many2One('company.company', 'Company', required=True)
+    date = fields.Date('Date', required=True)
+    grouping = fields.Selection([
+            ('party', 'Party'),
+            ('purchase', 'Purchase'),
+            ('product', 'Product'),
+            ], 'Grouping', required=True)
+
+    @classmethod
+    def default_company(cls):
+        return Transaction().context.get('company')
+
+    @classmethod
+    def default_date(cls):
+        pool = Pool()
+        Date = pool.get('ir.date')
+        return Date.today()
+
+    @staticmethod
+    def default_grouping():
+        return 'party'
+
+
+class ExportPendingInvoiceStart(ModelView):
+    'Export Pending Invoice Lines'
+    __name__ = 'purchase.pending_invoice.export.start'
+
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True)
+    format = fields.Selection([
+            ('csv', 'CSV'),
+            ('jsonl', 'JSON Lines'),
+            ], 'Format', required=True)
+    incremental = fields.Boolean('Since Last Export',
+        help="Export only the lines booked since the last export.")
+
+    @classmethod
+    def default_company(cls):
+        return Transaction().context.get('company')
+
+    @staticmethod
+    def default_format():
+        return 'csv'
+
+    @staticmethod
+    def default_incremental():
+        return True
+
+
+class ExportPendingInvoiceResult(ModelView):
+    'Export Pending Invoice Lines'
+    __name__ = 'purchase.pending_invoice.export.result'
+
+    url = fields.Char('URL', readonly=True,
+        help="The address to download the export from.\n"
+        "The file is streamed from the database when it is downloaded.")
+
+
+class ExportPendingInvoice(Wizard):
+    'Export Pending Invoice Lines'
+    __name__ = 'purchase.pending_invoice.export'
+
+    start = StateView('purchase.pending_invoice.export.start',
+        'purchase_stock_account_move.pending_invoice_export_start_view_form',
+        [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Export', 'export', 'tryton-ok', default=True),
+            ])
+    export = StateTransition()
+    result = StateView('purchase.pending_invoice.export.result',
+        'purchase_stock_account_move.pending_invoice_export_result_view_form',
+        [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    def transition_export(self):
+        pool = Pool()
+        Config = pool.get('purchase.configuration')
+        MoveLine = pool.get('account.move.line')
+
+        config = Config(1)
+        company = self.start.company
+        since = None
+        if self.start.incremental:
+            since = config.pending_invoice_export_watermark
+        # The export is bounded to the lines existing now so the watermark
+        # advanced once it is downloaded matches its content
+        until = MoveLine.get_pending_invoice_export_last_id(company.id)
+
+        query = {'f': self.start.format}
+        if since:
+            query['s'] = since
+        if until:
+            query['u'] = until
+        self.result.url = urllib.parse.urljoin(http_host(),
+            '/%s/purchase_stock_account_move/pending_invoice/%s?%s' % (
+                urllib.parse.quote(Transaction().database.name),
+                company.id, urllib.parse.urlencode(query)))
+        return 'result'
+
+    def default_result(self, fields):
+        return {
+            'url': self.result.url,
+            }
+
+
+class RevaluePendingInvoiceStart(ModelView):
+    'Revalue Pending Invoices'
+    __name__ = 'purchase.pending_invoice.revalue.start'
+
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True)
+    date = fields.Date('Date', required=True,
+        help="The closing date whose rates revalue the pending invoices.")
+
+    @classmethod
+    def default_company(cls):
+        return Transaction().context.get('company')
+
+    @classmethod
+    def default_date(cls):
+        pool = Pool()
+        Date = pool.get('ir.date')
+        return Date.today()
+
+
+class RevaluePendingInvoice(Wizard):
+    'Revalue Pending Invoices'
+    __name__ = 'purchase.pending_invoice.revalue'
+
+    start = StateView('purchase.pending_invoice.revalue.start',
+        'purchase_stock_account_move.pending_invoice_revalue_start_view_form',
+        [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Revalue', 'revalue', 'tryton-ok', default=True),
+            ])
+    revalue = StateAction('account.act_move_line_form')
+
+    def do_revalue(self, action):
+        pool = Pool()
+        PurchaseLine = pool.get('purchase.line')
 
-    def transition_handle(self):
-        with Transaction().set_context(stock_account_move=True):
-            return super(HandleShipmentException, self).transition_handle()
+        with Transaction().set_context(company=self.start.company.id,
+                _check_access=False):
+            moves = PurchaseLine.revalue_pending_invoice(self.start.date)
+        action['domain'] = PYSONEncoder().encode([
+                ('move', 'in', [m.id for m in moves]),
+                ])
+        return action, {}
@@ -0,0 +1,63 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.protocols.wrappers import (
+    HTTPStatus, Response, abort, with_pool, with_transaction)
+from trytond.transaction import Transaction
+from trytond.wsgi import app
+
+
+@app.route(
+    '/<database_name>/purchase_stock_account_move/pending_invoice/'
+    '<int:company>', methods={'GET'})
+@app.auth_required
+@with_pool
+@with_transaction(user='request', context=dict(_check_access=True))
+def pending_invoice(request, pool, company):
+    "Stream the pending invoice lines of company"
+    User = pool.get('res.user')
+    ModelAccess = pool.get('ir.model.access')
+
+    format_ = request.args.get('f', 'csv')
+    if format_ not in {'csv', 'jsonl'}:
+        abort(HTTPStatus.BAD_REQUEST)
+    try:
+        since, until = (
+            int(request.args[k]) if request.args.get(k) else None
+            for k in ['s', 'u'])
+    except ValueError:
+        abort(HTTPStatus.BAD_REQUEST)
+
+    user = User(Transaction().user)
+    if (company not in {c.id for c in user.companies}
+            or not ModelAccess.check(
+                'account.move.line', 'read', raise_exception=False)):
+        abort(HTTPStatus.FORBIDDEN)
+
+    database_name = pool.database_name
+    user_id = user.id
+
+    def generate():
+        # The request transaction is closed once the response is returned so
+        # the lines are read in a transaction living as long as the stream
+        with Transaction().start(database_name, user_id, readonly=True,
+                context={'company': company}):
+            MoveLine = pool.get('account.move.line')
+            yield from MoveLine.export_pending_invoice(
+                company, format_, since=since, until=until)
+        # The watermark is advanced only once the whole export is sent
+        if until:
+            with Transaction().start(database_name, user_id,
+                    context={'company': company}) as transaction:
+                MoveLine = pool.get('account.move.line')
+                MoveLine.set_pending_invoice_export_watermark(company, until)
+                transaction.commit()
+
+    mimetype = {
+        'csv': 'text/csv',
+        'jsonl': 'application/jsonl',
+        }[format_]
+    headers = {
+        'Content-Disposition': (
+            'attachment; filename="pending_invoice.%s"' % format_),
+        }
+    return Response(generate(), mimetype=mimetype, headers=headers)
@@ -0,0 +1,183 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+Benchmark the batched valuation of the pending invoice amounts against the
+per line path it replaced: Currency.compute for each line and date and one
+account move line search per line.
+
+The module is activated in the test database of the DB_NAME environment
+variable and the inputs are generated from a fixed seed so runs are
+comparable:
+
+    python -m trytond.modules.purchase_stock_account_move.tests.benchmark \
+        [size ...]
+"""
+import datetime
+import random
+import sys
+import time
+import tracemalloc
+from decimal import Decimal
+
+from trytond.modules.purchase_stock_account_move.purchase import (
+    _compute_pending_amounts)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import DB_NAME, USER, activate_module
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+SIZES = [1000, 10000, 100000]
+SEED = 0
+_ZERO = Decimal(0)
+
+
+def _create_currencies():
+    "Return the company currency and a foreign currency with their rates"
+    pool = Pool()
+    Currency = pool.get('currency.currency')
+    Rate = pool.get('currency.currency.rate')
+
+    currencies = Currency.create([{
+                'name': name,
+                'code': code,
+                'symbol': code,
+                } for name, code in [('Company', 'CMP'), ('Foreign', 'FRG')]])
+    Rate.create([{
+                'currency': currency.id,
+                'date': datetime.date.min,
+                'rate': rate,
+                } for currency, rate in zip(
+                currencies, [Decimal(1), Decimal('0.987654')])])
+    return currencies
+
+
+def _generate_inputs(generator, size, currencies):
+    "Return the rows and the booked amounts of size lines"
+    today = datetime.date(2024, 1, 1)
+    rows = []
+    booked = {}
+    for line_id in range(1, size + 1):
+        price = Decimal(generator.randint(1, 100000)) / 1000
+        currency = generator.choice(currencies)
+        for _ in range(generator.randint(1, 5)):
+            rows.append((line_id,
+                    today + datetime.timedelta(generator.randint(0, 10)),
+                    Decimal(generator.randint(-1000, 1000)) / 10,
+                    price, currency))
+        date = today + datetime.timedelta(generator.randint(0, 12))
+        booked[line_id, date] = (
+            Decimal(generator.randint(-1000, 1000)) / 100, None)
+    return rows, booked
+
+
+def _batch(rows, booked, company_currency):
+    "Value the rows like the batched booking"
+    pool = Pool()
+    Currency = pool.get('currency.currency')
+    MoveLine = pool.get('account.move.line')
+    transaction = Transaction()
+
+    # The booked amounts are read for a slice of lines at once
+    for sub_ids in grouped_slice(sorted({r[0] for r in rows})):
+        MoveLine.search([
+                ('purchase_line', 'in', list(sub_ids)),
+                ('account', '=', 1),
+                ])
+    rates = {}
+    columns = ([], [], [], [], [])
+    for line_id, date, quantity, price, currency in rows:
+        rate = None
+        if currency != company_currency:
+            key = (currency.id, date)
+            if key not in rates:
+                with transaction.set_context(date=date):
+                    Currency.compute(currency, _ZERO, company_currency)
+                    rates[key] = (
+                        Currency(company_currency.id).rate,
+                        Currency(currency.id).rate)
+            rate = rates[key]
+        for column, value in zip(
+                columns, [line_id, date, quantity, price, rate]):
+            column.append(value)
+    return [r[:3] for r in _compute_pending_amounts(
+            *columns, booked, company_currency.round)]
+
+
+def _per_line(rows, booked, company_currency):
+    "Value the rows like the per line booking"
+    pool = Pool()
+    Currency = pool.get('currency.currency')
+    MoveLine = pool.get('account.move.line')
+    transaction = Transaction()
+
+    lines = {}
+    for line_id, date, quantity, price, currency in rows:
+        line = lines.setdefault(line_id, (price, currency, {}))
+        line[-1][date] = line[-1].get(date, _ZERO) + quantity
+    line_booked = {}
+    for (line_id, date), (amount, _) in booked.items():
+        line_booked.setdefault(line_id, {})[date] = amount
+
+    result = []
+    for line_id in sorted(lines.keys() | line_booked.keys()):
+        price, currency, quantities = lines.get(
+            line_id, (_ZERO, company_currency, {}))
+        # The booked amounts are read for each line
+        MoveLine.search([
+                ('purchase_line', '=', line_id),
+                ('account', '=', 1),
+                ])
+        amounts = line_booked.get(line_id, {})
+        for date in sorted(quantities.keys() | amounts.keys()):
+            with transaction.set_context(date=date):
+                amount = Currency.compute(currency,
+                    quantities.get(date, _ZERO) * price, company_currency)
+            amount -= amounts.get(date, _ZERO)
+            if amount:
+                result.append((line_id, date, amount))
+    return result
+
+
+def _measure(func):
+    "Return the result, the duration and the peak memory of func"
+    start = time.perf_counter()
+    result = func()
+    duration = time.perf_counter() - start
+    # Tracing slows down the run so the memory is measured on its own
+    tracemalloc.start()
+    try:
+        func()
+        return result, duration, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(size):
+    "Return the duration and peak memory of the batch and per line runs"
+    with Transaction().start(DB_NAME, USER) as transaction:
+        company_currency, foreign_currency = _create_currencies()
+        rows, booked = _generate_inputs(random.Random(SEED), size,
+            [company_currency, foreign_currency])
+
+        batch, batch_time, batch_memory = _measure(
+            lambda: _batch(rows, booked, company_currency))
+        lines, lines_time, lines_memory = _measure(
+            lambda: _per_line(rows, booked, company_currency))
+        assert batch == lines
+        transaction.rollback()
+    return batch_time, batch_memory, lines_time, lines_memory
+
+
+def main(sizes):
+    activate_module('purchase_stock_account_move')
+    print('%10s %12s %12s %12s %12s' % (
+            'lines', 'batch (s)', 'batch (KiB)', 'line (s)', 'line (KiB)'))
+    for size in sizes:
+        batch_time, batch_memory, lines_time, lines_memory = run(size)
+        print('%10d %12.3f %12d %12.3f %12d' % (size,
+                batch_time, batch_memory // 1024,
+                lines_time, lines_memory // 1024))
+
+
+if __name__ == '__main__':
+    main([int(s) for s in sys.argv[1:]] or SIZES)
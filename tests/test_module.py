@@ -1,15 +1,99 @@
-
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import datetime
+import random
+from decimal import ROUND_HALF_EVEN, Decimal
 
 from trytond.modules.company.tests import CompanyTestMixin
+from trytond.modules.purchase_stock_account_move.purchase import (
+    _compute_pending_amounts)
 from trytond.tests.test_tryton import ModuleTestCase
 
 
+def _round(amount):
+    return amount.quantize(Decimal('0.01'), rounding=ROUND_HALF_EVEN)
+
+
+def _generate_pending_inputs(generator, size):
+    "Return the rows and the booked amounts of size lines"
+    today = datetime.date(2024, 1, 1)
+    rows = []
+    booked = {}
+    for line_id in range(1, size + 1):
+        price = Decimal(generator.randint(1, 100000)) / 1000
+        rate = generator.choice([
+                None, (Decimal('1.234567'), Decimal('0.987654'))])
+        for _ in range(generator.randint(1, 5)):
+            rows.append((line_id,
+                    today + datetime.timedelta(generator.randint(0, 10)),
+                    Decimal(generator.randint(-1000, 1000)) / 10,
+                    price, rate))
+        date = today + datetime.timedelta(generator.randint(0, 12))
+        booked[line_id, date] = (
+            Decimal(generator.randint(-1000, 1000)) / 100,
+            generator.choice([None, 1.5]))
+    return rows, booked
+
+
 class PurchaseStockAccountMoveTestCase(CompanyTestMixin, ModuleTestCase):
     'Test PurchaseStockAccountMove module'
     module = 'purchase_stock_account_move'
     extras = ['analytic_purchase']
 
+    def test_compute_pending_amounts(self):
+        "Test pending amounts are valued once per line and date"
+        today = datetime.date(2024, 1, 1)
+        tomorrow = today + datetime.timedelta(1)
+        rate = (Decimal('2'), Decimal('3'))
+
+        self.assertEqual(
+            _compute_pending_amounts(
+                [1, 1, 1, 2, 3],
+                [today, today, tomorrow, today, today],
+                [Decimal('0.1'), Decimal('0.1'), Decimal('-0.2'),
+                    Decimal('3'), Decimal('1')],
+                [Decimal('0.15')] * 3 + [Decimal('10'), Decimal('5')],
+                [None, None, None, rate, None],
+                {
+                    (1, today): (Decimal('0.02'), 0.1),
+                    (2, today): (Decimal('20.00'), None),
+                    (3, today): (Decimal('4.00'), None),
+                    (4, tomorrow): (Decimal('1.00'), 2.0),
+                    },
+                _round),
+            [
+                (1, today, Decimal('0.01'), 0.1),
+                (1, tomorrow, Decimal('-0.03'), -0.2),
+                (3, today, Decimal('1.00'), None),
+                (4, tomorrow, Decimal('-1.00'), -2.0),
+                ])
+
+    def test_compute_pending_amounts_random(self):
+        "Test pending amounts of random lines are valued per line and date"
+        rows, booked = _generate_pending_inputs(random.Random(0), 1000)
+
+        # Sum the quantities of each line and date and value them on their
+        # own like Currency.compute
+        buckets = {}
+        for line_id, date, quantity, price, rate in rows:
+            bucket = buckets.setdefault((line_id, date), [0, price, rate])
+            bucket[0] += quantity
+        expected = []
+        for line_id, date in sorted(buckets.keys() | booked.keys()):
+            quantity, price, rate = buckets.get(
+                (line_id, date), (0, Decimal(0), None))
+            amount = quantity * price
+            if rate:
+                amount = amount * rate[0] / rate[1]
+            booked_amount, booked_quantity = booked.get(
+                (line_id, date), (Decimal(0), 0))
+            amount = _round(amount) - booked_amount
+            if amount:
+                expected.append((line_id, date, amount,
+                        float(quantity) - booked_quantity
+                        if booked_quantity is not None else None))
+
+        self.assertEqual(
+            _compute_pending_amounts(*zip(*rows), booked, _round), expected)
 
 del ModuleTestCase
@@ -1,6 +1,6 @@
 import datetime
 import unittest
-from decimal import Decimal
+from decimal import ROUND_HALF_EVEN, Decimal
 
 from dateutil.relativedelta import relativedelta
 from proteus import Model, Wizard
@@ -635,3 +635,80 @@ class Test(unittest.TestCase):
             (past_3_days, Decimal('500.00')),
         ]
         self.assertEqual(got, expected)
+
+        # Receive many partial quantities of a decimal unit
+        set_user(1)
+        ProductUom = Model.get('product.uom')
+        kilogram, = ProductUom.find([('name', '=', 'Kilogram')])
+        template3 = ProductTemplate()
+        template3.name = 'product'
+        template3.account_category = account_category_tax
+        template3.default_uom = kilogram
+        template3.type = 'goods'
+        template3.purchasable = True
+        template3.list_price = Decimal('20')
+        template3.cost_price_method = 'fixed'
+        template3.save()
+        product3, = template3.products
+
+        set_user(purchase_user)
+        purchase = Purchase()
+        purchase.party = supplier
+        purchase.payment_term = payment_term
+        purchase_line = purchase.lines.new()
+        purchase_line.product = product3
+        purchase_line.quantity = 1.0
+        purchase_line.unit_price = Decimal('0.15')
+        purchase.click('quote')
+        purchase.click('confirm')
+        self.assertEqual(purchase.state, 'processing')
+
+        # The float sums of 0.1 kg are 0.30000000000000004 and
+        # 0.8999999999999999 after 3 and 9 receipts, which are valued across
+        # the half cent at 0.05 and 0.13 instead of 0.04 and 0.14
+        receipts = 10
+        for receipt in range(1, receipts + 1):
+            set_user(purchase_user)
+            purchase.reload()
+            move, = purchase.moves.find([('state', '=', 'draft')])
+            set_user(stock_user)
+            shipment = ShipmentIn()
+            shipment.supplier = supplier
+            incoming_move = Move(id=move.id)
+            incoming_move.quantity = 0.1
+            shipment.incoming_moves.append(incoming_move)
+            shipment.save()
+            ShipmentIn.receive([shipment.id], config.context)
+            ShipmentIn.do([shipment.id], config.context)
+            set_user(account_user)
+            account_moves = AccountMoveLine.find([
+                ('move_origin', '=', 'purchase.purchase,' + str(purchase.id)),
+                ('account', '=', pending_payable.id),
+            ])
+            self.assertEqual(
+                sum(l.credit - l.debit for l in account_moves),
+                (Decimal('0.1') * receipt * Decimal('0.15')).quantize(
+                    Decimal('0.01'), rounding=ROUND_HALF_EVEN))
+
+        set_user(purchase_user)
+        purchase.reload()
+        invoice = Invoice()
+        invoice.type = 'in'
+        invoice.party = purchase.party
+        set_user(account_user)
+        invoice.invoice_date = today
+        for invoice_line in purchase.invoice_lines:
+            invoice.lines.append(InvoiceLine(invoice_line.id))
+        invoice.save()
+        Invoice.post([invoice.id], config.context)
+
+        # Only one move per receipt and one for the invoice are generated
+        account_moves = AccountMoveLine.find([
+            ('move_origin', '=', 'purchase.purchase,' + str(purchase.id)),
+            ('account', '=', pending_payable.id),
+        ])
+        self.assertEqual(len(account_moves), receipts + 1)
+        self.assertEqual(sum(l.debit - l.credit for l in account_moves),
+                         Decimal('0.00'))
+        self.assertEqual(
+            all(a.reconciliation is not None for a in account_moves), True)
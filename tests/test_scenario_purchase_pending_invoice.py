@@ -0,0 +1,1200 @@
+import datetime
+import json
+import os
+import pstats
+import tempfile
+import tracemalloc
+import unittest
+from decimal import Decimal
+from unittest.mock import patch
+
+from proteus import Model, Wizard
+from trytond.modules.account.tests.tools import (
+    create_chart, create_fiscalyear, get_accounts)
+from trytond.modules.account_invoice.tests.tools import (
+    create_payment_term, set_fiscalyear_invoice_sequences)
+from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.modules.currency.tests.tools import get_currency
+from trytond.exceptions import UserError
+from trytond.pool import Pool
+from trytond.tests.test_tryton import DB_NAME, drop_db
+from trytond.tests.tools import activate_modules, set_user
+from trytond.transaction import Transaction
+
+
+class Test(unittest.TestCase):
+    "Test the booking of pending invoices"
+
+    def setUp(self):
+        drop_db()
+        super().setUp()
+
+        self.today = datetime.date.today()
+
+        # Activate purchase_stock_account_move
+        self.config = activate_modules('purchase_stock_account_move')
+
+        # Create company
+        _ = create_company()
+        self.company = get_company()
+
+        # Create fiscal year
+        fiscalyear = set_fiscalyear_invoice_sequences(
+            create_fiscalyear(self.company))
+        fiscalyear.click('create_period')
+
+        # Create chart of accounts and the pending account
+        _ = create_chart(self.company)
+        accounts = get_accounts(self.company)
+        self.revenue = accounts['revenue']
+        self.expense = accounts['expense']
+        Account = Model.get('account.account')
+        self.pending = Account()
+        self.pending.code = 'PR'
+        self.pending.name = 'Pending payable'
+        self.pending.type = accounts['payable'].type
+        self.pending.reconcile = True
+        self.pending.save()
+
+        # Configure purchase to track pending invoices in accounting
+        PurchaseConfig = Model.get('purchase.configuration')
+        purchase_config = PurchaseConfig(1)
+        purchase_config.purchase_invoice_method = 'shipment'
+        purchase_config.pending_invoice_account = self.pending
+        purchase_config.save()
+
+        # Create supplier
+        Party = Model.get('party.party')
+        self.supplier = Party(name='Supplier')
+        self.supplier.save()
+
+        # Create product
+        ProductCategory = Model.get('product.category')
+        self.account_category = ProductCategory(name="Account Category")
+        self.account_category.accounting = True
+        self.account_category.account_expense = self.expense
+        self.account_category.account_revenue = accounts['revenue']
+        self.account_category.save()
+        self.product = self.create_product(self.account_category)
+
+        # Create payment term
+        self.payment_term = create_payment_term()
+        self.payment_term.save()
+
+    def tearDown(self):
+        drop_db()
+        super().tearDown()
+
+    def create_product(self, account_category, unit='Unit'):
+        ProductUom = Model.get('product.uom')
+        ProductTemplate = Model.get('product.template')
+        uom, = ProductUom.find([('name', '=', unit)])
+        template = ProductTemplate()
+        template.name = 'product'
+        template.account_category = account_category
+        template.default_uom = uom
+        template.type = 'goods'
+        template.purchasable = True
+        template.list_price = Decimal('20')
+        template.cost_price_method = 'fixed'
+        template.save()
+        product, = template.products
+        return product
+
+    def create_purchase(self, quantity, unit_price, product=None,
+            currency=None):
+        Purchase = Model.get('purchase.purchase')
+        purchase = Purchase()
+        purchase.party = self.supplier
+        purchase.payment_term = self.payment_term
+        if currency:
+            purchase.currency = currency
+        purchase_line = purchase.lines.new()
+        purchase_line.product = product or self.product
+        purchase_line.quantity = quantity
+        purchase_line.unit_price = unit_price
+        purchase.click('quote')
+        purchase.click('confirm')
+        self.assertEqual(purchase.state, 'processing')
+        return purchase
+
+    def receive(self, purchase, quantity=None, book=True):
+        Move = Model.get('stock.move')
+        ShipmentIn = Model.get('stock.shipment.in')
+        purchase.reload()
+        move, = purchase.moves.find([('state', '=', 'draft')])
+        shipment = ShipmentIn()
+        shipment.supplier = self.supplier
+        incoming_move = Move(move.id)
+        if quantity is not None:
+            incoming_move.quantity = quantity
+        shipment.incoming_moves.append(incoming_move)
+        shipment.save()
+        if book:
+            shipment.click('receive')
+            shipment.click('do')
+        else:
+            context = dict(self.config.context, stock_account_move=True)
+            ShipmentIn.receive([shipment.id], context)
+            ShipmentIn.do([shipment.id], context)
+        return shipment
+
+    def invoice(self, purchase, invoice_date=None):
+        Invoice = Model.get('account.invoice')
+        InvoiceLine = Model.get('account.invoice.line')
+        purchase.reload()
+        invoice = Invoice()
+        invoice.type = 'in'
+        invoice.party = self.supplier
+        invoice.invoice_date = invoice_date or self.today
+        for invoice_line in purchase.invoice_lines:
+            if not invoice_line.invoice:
+                invoice.lines.append(InvoiceLine(invoice_line.id))
+        invoice.save()
+        invoice.click('post')
+        return invoice
+
+    def pending_lines(self, purchase):
+        MoveLine = Model.get('account.move.line')
+        return MoveLine.find([
+                ('purchase_line.purchase', '=', purchase.id),
+                ('account', '=', self.pending.id),
+                ])
+
+    def balance(self, lines):
+        return sum((l.debit - l.credit for l in lines), Decimal(0))
+
+    def book(self, purchase, amount, date=None):
+        "Post a manual move debiting amount to the pending account"
+        Journal = Model.get('account.journal')
+        Move = Model.get('account.move')
+        Period = Model.get('account.period')
+        date = date or self.today
+        journal, = Journal.find([('code', '=', 'EXP')])
+        period, = Period.find([
+                ('start_date', '<=', date),
+                ('end_date', '>=', date),
+                ('type', '=', 'standard'),
+                ])
+        purchase_line, = purchase.lines
+        move = Move()
+        move.period = period
+        move.journal = journal
+        move.date = date
+        line = move.lines.new()
+        line.account = self.pending
+        if line.account.party_required:
+            line.party = self.supplier
+        line.purchase_line = purchase_line
+        line.debit = amount
+        line = move.lines.new()
+        line.account = self.expense
+        line.credit = amount
+        move.click('post')
+        return move
+
+    def change_price(self, purchase, unit_price):
+        "Write the unit price of the line of a processing purchase"
+        purchase_line, = purchase.lines
+        with Transaction().start(DB_NAME, 1, context={
+                    'company': self.company.id,
+                    }) as transaction:
+            PurchaseLine = Pool().get('purchase.line')
+            PurchaseLine.write(
+                [PurchaseLine(purchase_line.id)], {'unit_price': unit_price})
+            transaction.commit()
+
+    def run_queue(self):
+        "Run the queued tasks like a worker"
+        with Transaction().start(DB_NAME, 0) as transaction:
+            Queue = Pool().get('ir.queue')
+            tasks = Queue.search([
+                    ('finished_at', '=', None),
+                    ], order=[('id', 'ASC')])
+            for task in tasks:
+                task.run()
+            Queue.save(tasks)
+            transaction.commit()
+
+    def call(self, model, method, *args):
+        "Call a server method which is not exposed to RPC"
+        with Transaction().start(DB_NAME, 1, context={
+                    'company': self.company.id,
+                    }) as transaction:
+            result = getattr(Pool().get(model), method)(*args)
+            if hasattr(result, '__next__'):
+                result = list(result)
+            transaction.commit()
+        return result
+
+    def test_fingerprint(self):
+        "Test unchanged lines are skipped until their inputs or booking change"
+        Purchase = Model.get('purchase.purchase')
+
+        purchase = self.create_purchase(5, Decimal('10'))
+        self.receive(purchase)
+        lines = self.pending_lines(purchase)
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(self.balance(lines), Decimal('-50.00'))
+        purchase.reload()
+        purchase_line, = purchase.lines
+        fingerprint = purchase_line.stock_account_move_fingerprint
+        self.assertTrue(fingerprint)
+
+        # Processing again skips the unchanged line
+        purchase.click('process')
+        purchase_line.reload()
+        self.assertEqual(
+            purchase_line.stock_account_move_fingerprint, fingerprint)
+        self.assertEqual(len(self.pending_lines(purchase)), 1)
+
+        # Cancelling the booked move invalidates the fingerprint
+        line, = lines
+        cancel = Wizard('account.move.cancel', [line.move])
+        cancel.execute('cancel')
+        self.assertEqual(
+            self.balance(self.pending_lines(purchase)), Decimal('0.00'))
+        purchase.click('process')
+        lines = self.pending_lines(purchase)
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(self.balance(lines), Decimal('-50.00'))
+        purchase_line.reload()
+        self.assertNotEqual(
+            purchase_line.stock_account_move_fingerprint, fingerprint)
+
+        # A full recompute books nothing when all is booked
+        Purchase.process([purchase.id], dict(
+                self.config.context, stock_account_move_recompute=True))
+        lines = self.pending_lines(purchase)
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(self.balance(lines), Decimal('-50.00'))
+
+        # Invoicing changes the fingerprint and books the reversal
+        self.invoice(purchase)
+        lines = self.pending_lines(purchase)
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(self.balance(lines), Decimal('0.00'))
+
+    def test_fingerprint_rates(self):
+        "Test only the rates until the last accounting date are fingerprinted"
+        CurrencyRate = Model.get('currency.currency.rate')
+
+        eur = get_currency('EUR')
+        purchase = self.create_purchase(5, Decimal('10'), currency=eur)
+        self.receive(purchase)
+        self.assertEqual(
+            self.balance(self.pending_lines(purchase)), Decimal('-25.00'))
+        purchase_line, = purchase.lines
+        purchase_line.reload()
+        fingerprint = purchase_line.stock_account_move_fingerprint
+
+        # A rate after the receipt does not value it
+        CurrencyRate(date=self.today + datetime.timedelta(days=1),
+            rate=Decimal('4'), currency=eur).save()
+        purchase.click('process')
+        purchase_line.reload()
+        self.assertEqual(
+            purchase_line.stock_account_move_fingerprint, fingerprint)
+        self.assertEqual(len(self.pending_lines(purchase)), 1)
+
+        # A rate of the receipt date revalues it
+        CurrencyRate(
+            date=self.today, rate=Decimal('4'), currency=eur).save()
+        purchase.click('process')
+        purchase_line.reload()
+        self.assertNotEqual(
+            purchase_line.stock_account_move_fingerprint, fingerprint)
+        lines = self.pending_lines(purchase)
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(self.balance(lines), Decimal('-12.50'))
+
+    def test_chunked(self):
+        "Test booking in chunks of lines with the cache cleared between them"
+        Purchase = Model.get('purchase.purchase')
+        Move = Model.get('stock.move')
+        ShipmentIn = Model.get('stock.shipment.in')
+
+        purchase = Purchase()
+        purchase.party = self.supplier
+        purchase.payment_term = self.payment_term
+        for quantity in [1, 2, 3]:
+            purchase_line = purchase.lines.new()
+            purchase_line.product = self.product
+            purchase_line.quantity = quantity
+            purchase_line.unit_price = Decimal('10')
+        purchase.click('quote')
+        purchase.click('confirm')
+
+        # Receive without booking
+        context = dict(self.config.context, stock_account_move=True)
+        shipment = ShipmentIn()
+        shipment.supplier = self.supplier
+        for move in purchase.moves:
+            shipment.incoming_moves.append(Move(move.id))
+        shipment.save()
+        ShipmentIn.receive([shipment.id], context)
+        ShipmentIn.do([shipment.id], context)
+        self.assertEqual(len(self.pending_lines(purchase)), 0)
+
+        # Book in chunks of one line without tracing the memory
+        context = dict(self.config.context, stock_account_move_chunk_size=1)
+        with patch.object(
+                tracemalloc, 'start', wraps=tracemalloc.start) as start:
+            Purchase.process([purchase.id], context)
+        start.assert_not_called()
+        lines = self.pending_lines(purchase)
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(self.balance(lines), Decimal('-60.00'))
+        purchase.reload()
+        self.assertTrue(all(
+                l.stock_account_move_fingerprint for l in purchase.lines))
+
+        # Nothing more is booked by the next chunked process
+        context['stock_account_move_trace'] = True
+        with patch.object(
+                tracemalloc, 'start', wraps=tracemalloc.start) as start:
+            Purchase.process([purchase.id], context)
+        start.assert_called_once_with()
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertEqual(len(self.pending_lines(purchase)), 3)
+
+    def test_chunked_reconcile(self):
+        "Test the balanced purchases are reconciled by slices of purchases"
+        balanced = self.create_purchase(5, Decimal('10'))
+        self.receive(balanced)
+        self.book(balanced, Decimal('50.00'))
+        unbalanced = self.create_purchase(5, Decimal('10'))
+        self.receive(unbalanced)
+        self.book(unbalanced, Decimal('40.00'))
+
+        with Transaction().start(DB_NAME, 1, context={
+                    'company': self.company.id,
+                    }) as transaction:
+            pool = Pool()
+            Account = pool.get('account.account')
+            Purchase = pool.get('purchase.purchase')
+            with patch('trytond.modules.purchase_stock_account_move.'
+                    'purchase.grouped_slice',
+                    side_effect=lambda r, c=1: ([x] for x in r)):
+                Purchase._reconcile_stock_account_moves(
+                    Purchase.browse([balanced.id, unbalanced.id]),
+                    Account(self.pending.id), clear_cache=True)
+            transaction.commit()
+
+        lines = self.pending_lines(balanced)
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(all(l.reconciliation for l in lines))
+        lines = self.pending_lines(unbalanced)
+        self.assertEqual(len(lines), 2)
+        self.assertFalse(any(l.reconciliation for l in lines))
+
+    def test_invoice_post(self):
+        "Test posting an invoice books its lines before the purchase process"
+        purchase = self.create_purchase(5, Decimal('10'))
+        self.receive(purchase)
+        self.assertEqual(
+            self.balance(self.pending_lines(purchase)), Decimal('-50.00'))
+
+        # The purchase process is queued for a worker which never runs
+        with patch('trytond.ir.queue_.has_worker', True):
+            self.invoice(purchase)
+        lines = self.pending_lines(purchase)
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(self.balance(lines), Decimal('0.00'))
+        self.assertTrue(all(l.reconciliation for l in lines))
+
+    def test_expense_account_resolved_lazily(self):
+        "Test lines with nothing to book do not need an expense account"
+        Purchase = Model.get('purchase.purchase')
+
+        purchase = self.create_purchase(5, Decimal('10'))
+        self.receive(purchase)
+        self.invoice(purchase)
+        self.assertEqual(
+            self.balance(self.pending_lines(purchase)), Decimal('0.00'))
+
+        # Remove the expense account once everything is booked
+        self.account_category.account_expense = None
+        self.account_category.save()
+
+        purchase.click('process')
+        Purchase.process([purchase.id], dict(
+                self.config.context, stock_account_move_recompute=True))
+        lines = self.pending_lines(purchase)
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(self.balance(lines), Decimal('0.00'))
+
+    def test_audit(self):
+        "Test the auditor values each accounting date like the booking"
+        Invoice = Model.get('account.invoice')
+        InvoiceLine = Model.get('account.invoice.line')
+
+        product = self.create_product(self.account_category, 'Kilogram')
+        purchase = self.create_purchase(0.2, Decimal('0.15'), product=product)
+        self.receive(purchase, 0.1)
+        self.receive(purchase, 0.1)
+        self.assertEqual(
+            self.balance(self.pending_lines(purchase)), Decimal('-0.03'))
+
+        # Invoice one receipt at another date
+        purchase.reload()
+        invoice_line = purchase.invoice_lines[0]
+        invoice = Invoice()
+        invoice.type = 'in'
+        invoice.party = self.supplier
+        if self.today.day != 1:
+            invoice.invoice_date = self.today.replace(day=1)
+        else:
+            invoice.invoice_date = self.today.replace(day=2)
+        invoice.lines.append(InvoiceLine(invoice_line.id))
+        invoice.save()
+        invoice.click('post')
+
+        # 0.2 valued today and -0.1 at the invoice date book 0.03 - 0.02
+        lines = self.pending_lines(purchase)
+        self.assertEqual(self.balance(lines), Decimal('-0.01'))
+        self.assertEqual(self.call(
+                'purchase.line', 'audit_pending_invoice', self.company.id),
+            [])
+
+        # Cancelled bookings are reported
+        cancel = Wizard('account.move.cancel', [lines[0].move])
+        cancel.execute('cancel')
+        purchase_line, = purchase.lines
+        (line_id, expected, booked), = self.call(
+            'purchase.line', 'audit_pending_invoice', self.company.id)
+        self.assertEqual(line_id, purchase_line.id)
+        self.assertEqual(expected, Decimal('0.01'))
+        self.assertNotEqual(booked, expected)
+
+    def test_audit_foreign_currency(self):
+        "Test the foreign currency purchases are audited at the booking rate"
+        CurrencyRate = Model.get('currency.currency.rate')
+        Purchase = Model.get('purchase.purchase')
+
+        eur = get_currency('EUR')
+        purchase = self.create_purchase(5, Decimal('10'), currency=eur)
+        self.receive(purchase)
+        self.assertEqual(
+            self.balance(self.pending_lines(purchase)), Decimal('-25.00'))
+        self.assertEqual(self.call(
+                'purchase.line', 'audit_pending_invoice', self.company.id),
+            [])
+
+        # A new rate at the receipt date is reported until booked
+        CurrencyRate(
+            date=self.today, rate=Decimal('4'), currency=eur).save()
+        purchase_line, = purchase.lines
+        (line_id, expected, booked), = self.call(
+            'purchase.line', 'audit_pending_invoice', self.company.id)
+        self.assertEqual(line_id, purchase_line.id)
+        self.assertEqual(expected, Decimal('12.50'))
+        self.assertEqual(booked, Decimal('25.00'))
+
+        Purchase.process([purchase.id], self.config.context)
+        self.assertEqual(
+            self.balance(self.pending_lines(purchase)), Decimal('-12.50'))
+        self.assertEqual(self.call(
+                'purchase.line', 'audit_pending_invoice', self.company.id),
+            [])
+
+    def test_isolated_batch(self):
+        "Test a failing purchase does not abort the batch"
+        Error = Model.get('purchase.stock_account_move.error')
+        Move = Model.get('stock.move')
+        Purchase = Model.get('purchase.purchase')
+        ShipmentIn = Model.get('stock.shipment.in')
+
+        account_category, = self.account_category.duplicate()
+        product = self.create_product(account_category)
+        purchase1 = self.create_purchase(5, Decimal('10'))
+        purchase2 = Purchase()
+        purchase2.party = self.supplier
+        purchase2.payment_term = self.payment_term
+        for line_product in [self.product, product]:
+            purchase_line = purchase2.lines.new()
+            purchase_line.product = line_product
+            purchase_line.quantity = 2
+            purchase_line.unit_price = Decimal('10')
+        purchase2.click('quote')
+        purchase2.click('confirm')
+
+        # Receive without booking
+        context = dict(self.config.context, stock_account_move=True)
+        shipment = ShipmentIn()
+        shipment.supplier = self.supplier
+        for purchase in [purchase1, purchase2]:
+            purchase.reload()
+            for move in purchase.moves:
+                shipment.incoming_moves.append(Move(move.id))
+        shipment.save()
+        ShipmentIn.receive([shipment.id], context)
+        ShipmentIn.do([shipment.id], context)
+
+        # The second purchase can not be booked without expense account
+        account_category.account_expense = None
+        account_category.save()
+        errors = self.call('purchase.purchase', 'create_pending_invoice_moves')
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(
+            self.balance(self.pending_lines(purchase1)), Decimal('-50.00'))
+        self.assertEqual(len(self.pending_lines(purchase2)), 0)
+        error, = Error.find([])
+        self.assertEqual(error.purchase, purchase2)
+        self.assertEqual(error.company, self.company)
+
+        # The error is cleared once the purchase is booked
+        account_category.account_expense = self.expense
+        account_category.save()
+        errors = self.call('purchase.purchase', 'create_pending_invoice_moves')
+        self.assertEqual(errors, [])
+        self.assertEqual(
+            self.balance(self.pending_lines(purchase2)), Decimal('-40.00'))
+        self.assertEqual(Error.find([]), [])
+
+    def test_error_access(self):
+        "Test the errors are read-only for the purchase users"
+        Company = Model.get('company.company')
+        Error = Model.get('purchase.stock_account_move.error')
+        Group = Model.get('res.group')
+        User = Model.get('res.user')
+
+        purchase = self.create_purchase(5, Decimal('10'))
+        self.call('purchase.stock_account_move.error', 'create', [{
+                    'purchase': purchase.id,
+                    'company': self.company.id,
+                    'message': "Error",
+                    }])
+        purchase_group, = Group.find([('name', '=', 'Purchase')])
+        user = User(name='Purchase', login='purchase')
+        user.groups.append(purchase_group)
+        user.companies.append(Company(self.company.id))
+        user.company = Company(self.company.id)
+        user.save()
+
+        set_user(user.id)
+        error, = Error.find([])
+        self.assertEqual(error.message, "Error")
+        error.message = "Changed"
+        with self.assertRaises(UserError):
+            error.save()
+        set_user(1)
+
+    def test_balance(self):
+        "Test the pending balance report as of a date"
+        Balance = Model.get('purchase.pending_invoice.balance')
+
+        purchase = self.create_purchase(5, Decimal('10'))
+        self.receive(purchase)
+        purchase.reload()
+
+        for grouping, record in [
+                ('party', self.supplier),
+                ('purchase', purchase),
+                ('product', self.product),
+                ]:
+            with self.config.set_context(
+                    date=self.today, grouping=grouping):
+                balance, = Balance.find([])
+                self.assertEqual(getattr(balance, grouping), record)
+                self.assertEqual(balance.balance, Decimal('50.00'))
+
+        with self.config.set_context(
+                date=self.today - datetime.timedelta(days=1)):
+            self.assertEqual(Balance.find([]), [])
+
+    def test_export(self):
+        "Test the export streams the lines booked since the last export"
+        PurchaseConfig = Model.get('purchase.configuration')
+
+        purchase = self.create_purchase(5, Decimal('10'))
+        self.receive(purchase)
+        line, = self.pending_lines(purchase)
+
+        export = Wizard('purchase.pending_invoice.export')
+        export.form.format = 'csv'
+        export.execute('export')
+        self.assertIn(
+            '/purchase_stock_account_move/pending_invoice/%s?f=csv&u=%s' % (
+                self.company.id, line.id),
+            export.form.url)
+        # The watermark waits for the download
+        self.assertIsNone(PurchaseConfig(1).pending_invoice_export_watermark)
+
+        data = b''.join(self.call('account.move.line',
+                'export_pending_invoice', self.company.id, 'csv', None,
+                line.id))
+        self.call('account.move.line',
+            'set_pending_invoice_export_watermark', self.company.id, line.id)
+        self.assertEqual(
+            PurchaseConfig(1).pending_invoice_export_watermark, line.id)
+        header, row, _ = data.decode('utf-8').split('\r\n')
+        self.assertEqual(header, ','.join(['id', 'purchase_id', 'purchase',
+                    'supplier_id', 'supplier', 'product_id', 'product',
+                    'date', 'quantity', 'amount']))
+        self.assertTrue(row.startswith('%s,%s,' % (line.id, purchase.id)))
+        self.assertTrue(row.endswith(',5.0,50.00'))
+
+        # Cancelling the booking cancels its quantity
+        cancel = Wizard('account.move.cancel', [line.move])
+        cancel.execute('cancel')
+        export = Wizard('purchase.pending_invoice.export')
+        export.form.format = 'jsonl'
+        export.execute('export')
+        self.assertIn('f=jsonl&s=%s&u=' % line.id, export.form.url)
+        data = b''.join(self.call('account.move.line',
+                'export_pending_invoice', self.company.id, 'jsonl',
+                line.id, None))
+        row, = data.decode('utf-8').splitlines()
+        row = json.loads(row)
+        self.assertEqual(row['quantity'], -5.0)
+        self.assertEqual(row['amount'], '-50.00')
+
+        # An earlier export downloaded later does not move the watermark back
+        self.call('account.move.line',
+            'set_pending_invoice_export_watermark', self.company.id,
+            line.id - 1)
+        self.assertEqual(
+            PurchaseConfig(1).pending_invoice_export_watermark, line.id)
+
+    def test_reconcile(self):
+        "Test the purchases are reconciled within the write-off tolerance"
+        Journal = Model.get('account.journal')
+        MoveLine = Model.get('account.move.line')
+        PurchaseConfig = Model.get('purchase.configuration')
+        WriteOff = Model.get('account.move.reconcile.write_off')
+
+        balanced = self.create_purchase(5, Decimal('10'))
+        self.receive(balanced)
+        self.book(balanced, Decimal('50.00'))
+        unbalanced = self.create_purchase(5, Decimal('10'))
+        self.receive(unbalanced)
+        self.book(unbalanced, Decimal('49.99'))
+
+        # Without write-off only the balanced purchase is reconciled
+        self.call('purchase.purchase', 'reconcile_pending_invoice_lines')
+        lines = self.pending_lines(balanced)
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(all(l.reconciliation for l in lines))
+        lines = self.pending_lines(unbalanced)
+        self.assertEqual(len(lines), 2)
+        self.assertFalse(any(l.reconciliation for l in lines))
+
+        journal = Journal(name='Write-Off', type='write-off')
+        journal.save()
+        write_off = WriteOff(name='Write Off')
+        write_off.journal = journal
+        write_off.debit_account = self.expense
+        write_off.credit_account = self.expense
+        write_off.save()
+        purchase_config = PurchaseConfig(1)
+        purchase_config.pending_invoice_write_off = write_off
+        purchase_config.pending_invoice_write_off_tolerance = Decimal('0.005')
+        purchase_config.save()
+
+        # The difference is above the tolerance
+        self.call('purchase.purchase', 'reconcile_pending_invoice_lines')
+        lines = self.pending_lines(unbalanced)
+        self.assertEqual(len(lines), 2)
+        self.assertFalse(any(l.reconciliation for l in lines))
+
+        # The difference is written off within the tolerance
+        purchase_config.pending_invoice_write_off_tolerance = Decimal('0.01')
+        purchase_config.save()
+        self.call('purchase.purchase', 'reconcile_pending_invoice_lines')
+        lines = self.pending_lines(unbalanced)
+        self.assertEqual(len(lines), 2)
+        reconciliation, = {l.reconciliation for l in lines}
+        self.assertTrue(reconciliation)
+        write_off_line, = MoveLine.find([
+                ('account', '=', self.pending.id),
+                ('move.journal', '=', journal.id),
+                ])
+        self.assertEqual(write_off_line.debit, Decimal('0.01'))
+        self.assertEqual(write_off_line.reconciliation, reconciliation)
+
+    def test_price_change(self):
+        "Test a price change books its delta at today"
+        Purchase = Model.get('purchase.purchase')
+
+        purchase = self.create_purchase(5, Decimal('10'))
+        self.receive(purchase)
+
+        # A higher price credits the difference
+        self.change_price(purchase, Decimal('12'))
+        lines = self.pending_lines(purchase)
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(self.balance(lines), Decimal('-60.00'))
+        delta, = [l for l in lines if l.purchase_quantity == 0]
+        self.assertEqual(delta.date, self.today)
+        self.assertEqual(delta.credit, Decimal('10.00'))
+        purchase_line, = purchase.lines
+        purchase_line.reload()
+        self.assertEqual(
+            purchase_line.stock_account_move_revaluation_date, self.today)
+        self.assertTrue(purchase_line.stock_account_move_fingerprint)
+
+        # A lower price debits the difference
+        self.change_price(purchase, Decimal('9'))
+        lines = self.pending_lines(purchase)
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(self.balance(lines), Decimal('-45.00'))
+        delta, = [l for l in lines if l.debit]
+        self.assertEqual(delta.debit, Decimal('15.00'))
+
+        # A full recompute of the merged amounts books nothing
+        Purchase.process([purchase.id], dict(
+                self.config.context, stock_account_move_recompute=True))
+        self.assertEqual(len(self.pending_lines(purchase)), 3)
+
+    def test_price_change_without_account(self):
+        "Test a price change books nothing without pending invoice account"
+        PurchaseConfig = Model.get('purchase.configuration')
+
+        purchase = self.create_purchase(5, Decimal('10'))
+        self.receive(purchase)
+        purchase_config = PurchaseConfig(1)
+        purchase_config.pending_invoice_account = None
+        purchase_config.save()
+
+        self.change_price(purchase, Decimal('12'))
+        lines = self.pending_lines(purchase)
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(self.balance(lines), Decimal('-50.00'))
+
+    def test_price_change_backdated(self):
+        "Test an invoice before the price change is booked at its date"
+        yesterday = self.today - datetime.timedelta(days=1)
+        if yesterday.year != self.today.year:
+            self.skipTest("Yesterday is not in the fiscal year")
+
+        purchase = self.create_purchase(5, Decimal('10'))
+        self.receive(purchase)
+        self.change_price(purchase, Decimal('12'))
+
+        invoice = self.invoice(purchase, invoice_date=yesterday)
+        self.assertEqual(invoice.invoice_date, yesterday)
+        lines = self.pending_lines(purchase)
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(self.balance(lines), Decimal('0.00'))
+        reversal, = [l for l in lines if l.debit]
+        self.assertEqual(reversal.date, self.today)
+        self.assertEqual(reversal.debit, Decimal('60.00'))
+
+    def test_price_change_later(self):
+        "Test the amounts booked after the price change are left to process"
+        tomorrow = self.today + datetime.timedelta(days=1)
+        if tomorrow.year != self.today.year:
+            self.skipTest("Tomorrow is not in the fiscal year")
+
+        purchase = self.create_purchase(5, Decimal('10'))
+        self.receive(purchase)
+        self.book(purchase, Decimal('5.00'), date=tomorrow)
+
+        self.change_price(purchase, Decimal('12'))
+        lines = self.pending_lines(purchase)
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(self.balance(lines), Decimal('-55.00'))
+
+        # The next process corrects the booking of tomorrow
+        purchase.click('process')
+        lines = self.pending_lines(purchase)
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(self.balance(lines), Decimal('-60.00'))
+        correction, = [l for l in lines
+            if l.date == tomorrow and l.credit]
+        self.assertEqual(correction.credit, Decimal('5.00'))
+
+    def test_price_change_foreign_currency(self):
+        "Test the delta of a price change is converted"
+        eur = get_currency('EUR')
+
+        purchase = self.create_purchase(5, Decimal('10'), currency=eur)
+        self.receive(purchase)
+        self.assertEqual(
+            self.balance(self.pending_lines(purchase)), Decimal('-25.00'))
+
+        self.change_price(purchase, Decimal('12'))
+        lines = self.pending_lines(purchase)
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(self.balance(lines), Decimal('-30.00'))
+        delta, = [l for l in lines if l.purchase_quantity == 0]
+        self.assertEqual(delta.credit, Decimal('5.00'))
+
+    def test_revalue(self):
+        "Test the revaluation of the open foreign currency pending balance"
+        AccountConfig = Model.get('account.configuration')
+        CurrencyRate = Model.get('currency.currency.rate')
+        Journal = Model.get('account.journal')
+        MoveLine = Model.get('account.move.line')
+        PurchaseConfig = Model.get('purchase.configuration')
+
+        eur = get_currency('EUR')
+        purchase = self.create_purchase(5, Decimal('10'), currency=eur)
+        self.receive(purchase)
+        domestic = self.create_purchase(5, Decimal('10'))
+        self.receive(domestic)
+        self.assertEqual(
+            self.balance(self.pending_lines(purchase)), Decimal('-25.00'))
+        CurrencyRate(
+            date=self.today, rate=Decimal('4'), currency=eur).save()
+
+        # Nothing is revalued without pending invoice account
+        purchase_config = PurchaseConfig(1)
+        purchase_config.pending_invoice_account = None
+        purchase_config.save()
+        self.assertEqual(self.call(
+                'purchase.line', 'revalue_pending_invoice', self.today), [])
+        purchase_config.pending_invoice_account = self.pending
+        purchase_config.save()
+
+        # The currency exchange configuration is required
+        with self.assertRaises(UserError):
+            self.call('purchase.line', 'revalue_pending_invoice', self.today)
+        self.assertEqual(len(self.pending_lines(purchase)), 1)
+
+        journal = Journal(name='Currency Exchange', type='write-off')
+        journal.save()
+        account_config = AccountConfig(1)
+        account_config.currency_exchange_journal = journal
+        account_config.currency_exchange_credit_account = self.revenue
+        account_config.currency_exchange_debit_account = self.expense
+        account_config.save()
+
+        move, = self.call(
+            'purchase.line', 'revalue_pending_invoice', self.today)
+        lines = self.pending_lines(purchase)
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(self.balance(lines), Decimal('-12.50'))
+        revaluation, = MoveLine.find([
+                ('move', '=', move.id),
+                ('account', '=', self.pending.id),
+                ])
+        self.assertEqual(revaluation.purchase_line, purchase.lines[0])
+        self.assertEqual(revaluation.debit, Decimal('12.50'))
+        exchange, = MoveLine.find([
+                ('move', '=', move.id),
+                ('account', '=', self.revenue.id),
+                ])
+        self.assertEqual(exchange.credit, Decimal('12.50'))
+        self.assertEqual(len(self.pending_lines(domestic)), 1)
+        purchase_line, = purchase.lines
+        purchase_line.reload()
+        self.assertEqual(
+            purchase_line.stock_account_move_revaluation_date, self.today)
+
+        # The revalued balance is up to date
+        self.assertEqual(self.call(
+                'purchase.line', 'revalue_pending_invoice', self.today), [])
+        self.assertEqual(len(self.pending_lines(purchase)), 2)
+
+    def test_revalue_missing_rate(self):
+        "Test the revaluation fails without rate at date"
+        CurrencyRate = Model.get('currency.currency.rate')
+
+        eur = get_currency('EUR')
+        purchase = self.create_purchase(5, Decimal('10'), currency=eur)
+        self.receive(purchase)
+        CurrencyRate.delete(CurrencyRate.find([('currency', '=', eur.id)]))
+        CurrencyRate(
+            date=self.today + datetime.timedelta(days=1), rate=Decimal('4'),
+            currency=eur).save()
+
+        with self.assertRaises(UserError):
+            self.call('purchase.line', 'revalue_pending_invoice', self.today)
+        self.assertEqual(len(self.pending_lines(purchase)), 1)
+        purchase_line, = purchase.lines
+        purchase_line.reload()
+        self.assertIsNone(purchase_line.stock_account_move_revaluation_date)
+
+    def test_batch_equivalence(self):
+        "Test the batched booking matches the per line booking"
+        eur = get_currency('EUR')
+        kg = self.create_product(self.account_category, 'Kilogram')
+
+        purchases = []
+        purchase = self.create_purchase(5, Decimal('10'))
+        self.receive(purchase, 3)
+        self.receive(purchase, book=False)
+        purchases.append(purchase)
+        purchase = self.create_purchase(7, Decimal('3.33'), currency=eur)
+        self.receive(purchase, 4)
+        self.receive(purchase, book=False)
+        purchases.append(purchase)
+        purchase = self.create_purchase(0.3, Decimal('0.15'), product=kg)
+        self.receive(purchase, 0.1, book=False)
+        self.receive(purchase, 0.1, book=False)
+        purchases.append(purchase)
+        line_ids = [l.id for p in purchases for l in p.lines]
+
+        with Transaction().start(DB_NAME, 1, context={
+                    'company': self.company.id,
+                    'stock_account_move_recompute': True,
+                    }) as transaction:
+            pool = Pool()
+            Config = pool.get('purchase.configuration')
+            Currency = pool.get('currency.currency')
+            MoveLine = pool.get('account.move.line')
+            PurchaseLine = pool.get('purchase.line')
+            account = Config(1).pending_invoice_account
+            lines = PurchaseLine.browse(line_ids)
+
+            def summary(moves):
+                result = []
+                for move in moves:
+                    line, = [l for l in move.lines if l.account == account]
+                    result.append((line.purchase_line.id, move.date,
+                            line.credit - line.debit, line.purchase_quantity))
+                return result
+
+            batched = summary(PurchaseLine._get_stock_account_moves_lines(
+                    lines, account))
+            per_line = summary([m for l in lines
+                    for m in PurchaseLine._get_stock_account_moves_lines(
+                        [l], account)])
+            self.assertEqual(batched, per_line)
+
+            # Value each date of each line with Currency.compute
+            reference = []
+            for line in lines:
+                quantities = line._get_pending_quantities()
+                amounts = {}
+                for move_line in MoveLine.search([
+                            ('purchase_line', '=', line.id),
+                            ('account', '=', account.id),
+                            ]):
+                    amounts[move_line.date] = (
+                        amounts.get(move_line.date, Decimal(0))
+                        + move_line.credit - move_line.debit)
+                for date in sorted(quantities.keys() | amounts.keys()):
+                    with transaction.set_context(date=date):
+                        amount = Currency.compute(line.purchase.currency,
+                            quantities.get(date, Decimal(0))
+                            * line.unit_price,
+                            line.purchase.company.currency)
+                    amount -= amounts.get(date, Decimal(0))
+                    if amount:
+                        reference.append((line.id, date, amount))
+            self.assertEqual([r[:3] for r in batched], reference)
+            self.assertEqual(len(batched), 3)
+
+    def test_shipment_cancel(self):
+        "Test the reversal of cancelled receipts is booked once processed"
+        Move = Model.get('stock.move')
+        ShipmentIn = Model.get('stock.shipment.in')
+
+        purchases = [
+            self.create_purchase(5, Decimal('10')),
+            self.create_purchase(2, Decimal('10')),
+            ]
+        shipment = ShipmentIn()
+        shipment.supplier = self.supplier
+        for purchase in purchases:
+            purchase.reload()
+            for move in purchase.moves:
+                shipment.incoming_moves.append(Move(move.id))
+        shipment.save()
+        shipment.click('receive')
+        self.assertEqual(
+            [self.balance(self.pending_lines(p)) for p in purchases],
+            [Decimal('-50.00'), Decimal('-20.00')])
+
+        # The purchases are processed by a worker after the cancellation
+        with patch('trytond.ir.queue_.has_worker', True):
+            shipment.click('cancel')
+        self.assertEqual(
+            [self.balance(self.pending_lines(p)) for p in purchases],
+            [Decimal('-50.00'), Decimal('-20.00')])
+
+        # The process books the reversal of the updated invoice lines
+        self.run_queue()
+        for purchase in purchases:
+            lines = self.pending_lines(purchase)
+            self.assertEqual(len(lines), 2)
+            self.assertEqual(self.balance(lines), Decimal('0.00'))
+            self.assertTrue(all(l.reconciliation for l in lines))
+        self.assertEqual(self.call(
+                'purchase.line', 'audit_pending_invoice', self.company.id),
+            [])
+
+    def test_handle_shipment_exception(self):
+        "Test the purchases handled by the wizard are booked once processed"
+        Move = Model.get('stock.move')
+        ShipmentIn = Model.get('stock.shipment.in')
+
+        purchase = self.create_purchase(5, Decimal('10'))
+        shipment = ShipmentIn()
+        shipment.supplier = self.supplier
+        move, = purchase.moves
+        shipment.incoming_moves.append(Move(move.id))
+        shipment.save()
+        shipment.click('receive')
+        shipment.click('cancel')
+        purchase.reload()
+        self.assertEqual(purchase.shipment_state, 'exception')
+        self.assertEqual(
+            self.balance(self.pending_lines(purchase)), Decimal('0.00'))
+
+        # The handling is processed by a worker
+        with patch('trytond.ir.queue_.has_worker', True):
+            handle = purchase.click('handle_shipment_exception')
+            handle.form.recreate_moves.extend(
+                handle.form.recreate_moves.find())
+            handle.execute('handle')
+        self.run_queue()
+        purchase.reload()
+        self.assertEqual(purchase.shipment_state, 'waiting')
+
+        self.receive(purchase)
+        lines = self.pending_lines(purchase)
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(self.balance(lines), Decimal('-50.00'))
+        self.assertEqual(self.call(
+                'purchase.line', 'audit_pending_invoice', self.company.id),
+            [])
+
+    def test_multi_company(self):
+        "Test a batch of purchases of two companies is booked per company"
+        Account = Model.get('account.account')
+        Company = Model.get('company.company')
+        MoveLine = Model.get('account.move.line')
+        Party = Model.get('party.party')
+        ProductCategory = Model.get('product.category')
+        PurchaseConfig = Model.get('purchase.configuration')
+
+        purchase1 = self.create_purchase(5, Decimal('10'))
+        self.receive(purchase1, book=False)
+
+        # Create a second company which becomes the current one
+        _ = create_company(Party(name='Company 2'))
+        company2, = Company.find([('id', '!=', self.company.id)])
+        fiscalyear = set_fiscalyear_invoice_sequences(
+            create_fiscalyear(company2))
+        fiscalyear.click('create_period')
+        _ = create_chart(company2)
+        accounts = get_accounts(company2)
+        pending2 = Account()
+        pending2.code = 'PR'
+        pending2.name = 'Pending payable'
+        pending2.type = accounts['payable'].type
+        pending2.reconcile = True
+        pending2.save()
+        purchase_config = PurchaseConfig(1)
+        purchase_config.purchase_invoice_method = 'shipment'
+        purchase_config.pending_invoice_account = pending2
+        purchase_config.save()
+        account_category = ProductCategory(name="Account Category 2")
+        account_category.accounting = True
+        account_category.account_expense = accounts['expense']
+        account_category.account_revenue = accounts['revenue']
+        account_category.save()
+        product = self.create_product(account_category)
+
+        purchase2 = self.create_purchase(5, Decimal('20'), product=product)
+        self.receive(purchase2, book=False)
+
+        # The groups of companies are queued
+        purchase_ids = [purchase1.id, purchase2.id]
+        with Transaction().start(DB_NAME, 1, context={
+                    'company': self.company.id,
+                    'stock_account_move_queue': True,
+                    }) as transaction:
+            Purchase = Pool().get('purchase.purchase')
+            with patch('trytond.ir.queue_.has_worker', True):
+                Purchase.create_stock_account_moves(
+                    Purchase.browse(purchase_ids))
+            transaction.commit()
+        self.assertEqual(MoveLine.find([
+                    ('purchase_line.purchase', 'in', purchase_ids),
+                    ]), [])
+
+        # Each group is booked with the configuration of its company
+        self.run_queue()
+        for purchase, company, account, balance in [
+                (purchase1, self.company, self.pending, Decimal('-50.00')),
+                (purchase2, company2, pending2, Decimal('-100.00')),
+                ]:
+            lines = MoveLine.find([
+                    ('purchase_line.purchase', '=', purchase.id),
+                    ('account', '=', account.id),
+                    ], context={'company': company.id})
+            self.assertEqual(len(lines), 1)
+            self.assertEqual(self.balance(lines), balance)
+            line, = lines
+            self.assertEqual(line.move.company, company)
+            self.assertEqual(line.move.period.fiscalyear.company, company)
+
+    def test_profile(self):
+        "Test the slow bookings are profiled per purchase"
+        Purchase = Model.get('purchase.purchase')
+
+        purchase = self.create_purchase(5, Decimal('10'))
+        self.receive(purchase, book=False)
+
+        with tempfile.TemporaryDirectory() as directory, patch(
+                'trytond.modules.purchase_stock_account_move.purchase.'
+                '_PROFILE_DIRECTORY', directory):
+            # Fast bookings are not dumped
+            Purchase.process([purchase.id], dict(self.config.context,
+                    stock_account_move_profile=3600))
+            self.assertEqual(os.listdir(directory), [])
+            self.assertEqual(
+                self.balance(self.pending_lines(purchase)), Decimal('-50.00'))
+
+            Purchase.process([purchase.id], dict(self.config.context,
+                    stock_account_move_profile=0,
+                    stock_account_move_recompute=True))
+            filename, = os.listdir(directory)
+            self.assertTrue(filename.startswith(
+                    'purchase-%s-lines-1-invoice-lines-1-' % purchase.id))
+            stats = pstats.Stats(os.path.join(directory, filename))
+            self.assertTrue(stats.total_calls)
+        self.assertEqual(len(self.pending_lines(purchase)), 1)
+
+    def test_line_ids(self):
+        "Test only the received goods lines invoiced on shipment are selected"
+        Move = Model.get('stock.move')
+        Purchase = Model.get('purchase.purchase')
+        ShipmentIn = Model.get('stock.shipment.in')
+
+        service = self.create_product(self.account_category)
+        service.template.type = 'service'
+        service.template.save()
+
+        purchases = []
+        for invoice_method in ['shipment', 'order']:
+            purchase = Purchase()
+            purchase.party = self.supplier
+            purchase.payment_term = self.payment_term
+            purchase.invoice_method = invoice_method
+            for product in [self.product, self.product, service]:
+                purchase_line = purchase.lines.new()
+                purchase_line.product = product
+                purchase_line.quantity = 1
+                purchase_line.unit_price = Decimal('10')
+            purchase.click('quote')
+            purchase.click('confirm')
+            purchases.append(purchase)
+
+        # Receive only the first line of each purchase
+        shipment = ShipmentIn()
+        shipment.supplier = self.supplier
+        for purchase in purchases:
+            purchase.reload()
+            move = min(purchase.moves, key=lambda m: m.origin.id)
+            shipment.incoming_moves.append(Move(move.id))
+        shipment.save()
+        shipment.click('receive')
+
+        with Transaction().start(DB_NAME, 1, context={
+                    'company': self.company.id,
+                    }):
+            pool = Pool()
+            PurchaseLine = pool.get('purchase.line')
+            line_ids = PurchaseLine._get_stock_account_move_line_ids(
+                pool.get('purchase.purchase').browse(
+                    [p.id for p in purchases]))
+        purchase = purchases[0]
+        self.assertEqual(dict(line_ids), {
+                purchase.id: [min(l.id for l in purchase.lines)],
+                })